@@ -0,0 +1,183 @@
+import argparse
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+WORDS = ("notebook kernel cell output index chunk vector search answer token stream latency cache "
+         "reference page model prompt budget context history summary embedding retrieval").split()
+
+
+def make_text(seed, n_words):
+    digest = hashlib.sha1(str(seed).encode("utf-8")).digest()
+    return " ".join(WORDS[(digest[i % len(digest)] + i) % len(WORDS)] for i in range(n_words))
+
+
+def make_answer(n_tokens):
+    body = make_text("answer", max(n_tokens - 20, 1))
+    return (f"Applicable References: [citation:1] [citation:2]\n"
+            f"Answer: {body} [citation:1].\n"
+            f"Follow-up Questions:\nWhat is a kernel?\nHow are cells indexed?\nWhy is the cache needed?")
+
+
+def make_page(path, n_words):
+    paragraphs = [make_text(f"{path}-{i}", 60) for i in range(max(n_words // 60, 1))]
+    return (f"Title: Page {path}\n\nURL Source: {path}\n\nMarkdown Content:\n# Page {path}\n\n"
+            + "\n\n".join(paragraphs))
+
+
+def make_vector(text, dim=64):
+    digest = hashlib.sha256(text.encode("utf-8")).digest()
+    vector = [digest[i % len(digest)] / 255 - 0.5 for i in range(dim)]
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings = {
+        "token_rate": 200,
+        "ttft": 0.2,
+        "answer_tokens": 300,
+        "search_latency": 0.05,
+        "search_results": 10,
+        "page_latency": 0.05,
+        "page_words": 3000
+    }
+
+    def _send(self, status, body, content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path == "/health":
+            self._send(200, {"status": "ok", "model": "mock-embedding"})
+        elif parsed.path == "/v7.0/search":
+            self.search(parse_qs(parsed.query).get("q", [""])[0])
+        elif parsed.path.startswith("/reader/"):
+            self.read_page(unquote(self.path[len("/reader/"):]))
+        else:
+            self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        if path == "/v1/chat/completions":
+            self.chat_completions(self._read_json())
+        elif path == "/embed":
+            texts = self._read_json().get("texts", [])
+            self._send(200, {"embeddings": [make_vector(text) for text in texts]})
+        else:
+            self._send(404, {"error": "not found"})
+
+    def search(self, query):
+        time.sleep(self.settings["search_latency"])
+        results = [{
+            "name": f"Result {i} for {query}",
+            "url": f"http://pages.test/{hashlib.sha1(query.encode('utf-8')).hexdigest()[:8]}/{i}",
+            "snippet": make_text(f"{query}-{i}", 80)
+        } for i in range(self.settings["search_results"])]
+        self._send(200, {"webPages": {"value": results}})
+
+    def read_page(self, url):
+        time.sleep(self.settings["page_latency"])
+        etag = '"' + hashlib.sha1(url.encode("utf-8")).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self._send(200, make_page(url, self.settings["page_words"]), "text/plain", {"ETag": etag})
+
+    def chat_completions(self, request):
+        model = request.get("model", "mock")
+        answer = make_answer(self.settings["answer_tokens"])
+        prompt_tokens = sum(len(str(message.get("content", "")).split()) for message in request.get("messages", []))
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(answer.split()),
+            "total_tokens": prompt_tokens + len(answer.split())
+        }
+        time.sleep(self.settings["ttft"])
+        if not request.get("stream"):
+            time.sleep(len(answer.split()) / self.settings["token_rate"])
+            self._send(200, {
+                "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        tokens = answer.split(" ")
+        interval = 1 / self.settings["token_rate"]
+        for i, token in enumerate(tokens):
+            chunk = {
+                "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": {"content": token if i == 0 else " " + token}, "finish_reason": None}]
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(interval)
+        last = {
+            "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage
+        }
+        self.wfile.write(f"data: {json.dumps(last)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(host="127.0.0.1", port=0, **settings):
+    MockHandler.settings = dict(MockHandler.settings, **settings)
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="nbpilot-mock-server", daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="mock_servers", description="local stand-ins for the llm, search and reader apis")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--token_rate", type=float, default=200, help="streamed tokens per second")
+    parser.add_argument("--ttft", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--answer_tokens", type=int, default=300)
+    parser.add_argument("--search_latency", type=float, default=0.05)
+    parser.add_argument("--page_latency", type=float, default=0.05)
+    parser.add_argument("--page_words", type=int, default=3000)
+    args = parser.parse_args()
+    settings = {key: value for key, value in vars(args).items() if key not in ("host", "port")}
+    server = start_server(args.host, args.port, **settings)
+    print(f"mock servers listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
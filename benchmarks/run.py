@@ -0,0 +1,220 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import json
+import os
+from pathlib import Path
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from mock_servers import start_server
+
+
+ROOT = Path(__file__).resolve().parent.parent
+WORKLOADS = ["chat", "search", "index", "ask", "summarize", "agent"]
+
+
+def write_config(base_url, workdir, tool_cache=False):
+    with open(ROOT / "config/config.json", encoding="utf-8") as fi:
+        config = json.load(fi)
+    config["llm"]["mock"] = {
+        "base_url": base_url + "/v1",
+        "api_key": "mock",
+        "api_version": None,
+        "model_name": "openai/mock"
+    }
+    config["cache_dir"] = str(workdir / "cache")
+    config["llm_cache"]["enabled"] = False
+    config["rag"]["index_dir"] = str(workdir / "indexes")
+    config["rag"]["embedding"].update({"backend": "server", "preload": False, "cache": {"enabled": False}})
+    config["rag"]["embedding"]["server"] = {"url": base_url}
+    config["tools"]["reader_url"] = base_url + "/reader/"
+    config["tools"]["search"].update({"bing_url": base_url + "/v7.0/search", "engines": ["ms"]})
+    config["tools"]["cache"]["enabled"] = tool_cache
+    config.setdefault("tracing", {}).update({"enabled": True, "export_path": None})
+    path = workdir / "config.json"
+    with open(path, "w", encoding="utf-8") as fo:
+        json.dump(config, fo, indent=4)
+    return path
+
+
+def create_workloads(pages):
+    from nbpilot.agent import Agent
+    from nbpilot.nbpilot import call_nbpilot, summarize_webpage
+    from nbpilot.rag import build_index_from_urls, retrieve_and_answer, search_and_answer
+
+    page_urls = [f"http://pages.test/docs/{j}" for j in range(pages)]
+
+    def chat(i):
+        call_nbpilot(f"how do I speed up cell {i}?", None, provider="mock", history_turns=3)
+
+    def search(i):
+        search_and_answer([], f"benchmark query {i}", provider="mock", engine="ms")
+
+    def index(i):
+        build_index_from_urls([f"http://pages.test/index-{i}/{j}" for j in range(pages)], f"bench-{i}")
+
+    def ask(i):
+        retrieve_and_answer(f"what does page {i % pages} say about the cache?", "bench-ask", provider="mock")
+
+    def summarize(i):
+        summarize_webpage(f"http://pages.test/summary/{i}", provider="mock")
+
+    def agent(i):
+        Agent([]).run(f"plan task {i}", provider="mock")
+
+    setups = {"ask": lambda: build_index_from_urls(page_urls, "bench-ask")}
+    workloads = {"chat": chat, "search": search, "index": index, "ask": ask, "summarize": summarize, "agent": agent}
+    return workloads, setups
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def run_workload(name, func, iterations, concurrency, warmup, trace_memory):
+    from nbpilot.tracing import tracer
+
+    for i in range(warmup):
+        func(-i - 1)
+    tracer.clear()
+    if trace_memory:
+        tracemalloc.start()
+
+    def timed(i):
+        start = time.perf_counter()
+        try:
+            func(i)
+            return time.perf_counter() - start, None
+        except Exception as e:
+            return time.perf_counter() - start, f"{type(e).__name__}: {e}"
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(iterations)))
+    wall = time.perf_counter() - start
+    python_peak = None
+    if trace_memory:
+        python_peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    latencies = [latency for latency, error in results if error is None]
+    errors = [error for _, error in results if error is not None]
+    return {
+        "workload": name,
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies) if latencies else None,
+        "throughput": iterations / wall if wall else None,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "python_peak_mb": python_peak,
+        "stages": tracer.stats()
+    }
+
+
+def print_report(reports):
+    print(f"{'workload':<10} {'n':>4} {'err':>4} {'p50':>8} {'p90':>8} {'p99':>8} {'ops/s':>7} {'rss':>8} {'py peak':>8}")
+    for report in reports:
+        print(f"{report['workload']:<10} {report['iterations']:>4} {report['errors']:>4} "
+              f"{format_number(report['p50'], 's', 3):>8} {format_number(report['p90'], 's', 3):>8} "
+              f"{format_number(report['p99'], 's', 3):>8} {format_number(report['throughput'], '', 2):>7} "
+              f"{format_number(report['max_rss_mb'], 'M', 0):>8} {format_number(report['python_peak_mb'], 'M', 1):>8}")
+        if report["first_error"]:
+            print(f"  first error: {report['first_error']}")
+        for stage in report["stages"]:
+            print(f"  {stage['name']:<22} x{stage['count']:<4} p50 {format_number(stage['p50'], 's', 3):>8} "
+                  f"total {format_number(stage['total'], 's', 2):>8}")
+
+
+def format_number(value, unit="", digits=2):
+    return f"{value:.{digits}f}{unit}" if value is not None else "-"
+
+
+def compare(reports, baseline_path, tolerance):
+    with open(baseline_path, encoding="utf-8") as fi:
+        baseline = {report["workload"]: report for report in json.load(fi)}
+    regressions = []
+    for report in reports:
+        previous = baseline.get(report["workload"])
+        if previous is None:
+            continue
+        for metric in ("p50", "p90"):
+            if previous.get(metric) and report[metric] and report[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{report['workload']} {metric}: {previous[metric]:.3f}s -> {report[metric]:.3f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="benchmarks/run.py", description="run nbpilot workloads against local mock servers")
+    parser.add_argument("--workloads", default="all", help=f"comma separated workloads out of {','.join(WORKLOADS)}")
+    parser.add_argument("--iterations", "-n", type=int, default=10)
+    parser.add_argument("--concurrency", "-c", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--pages", type=int, default=8, help="pages per index")
+    parser.add_argument("--token_rate", type=float, default=200, help="streamed tokens per second of the mock llm")
+    parser.add_argument("--ttft", type=float, default=0.2, help="seconds before the mock llm sends the first token")
+    parser.add_argument("--answer_tokens", type=int, default=300)
+    parser.add_argument("--search_latency", type=float, default=0.05)
+    parser.add_argument("--page_latency", type=float, default=0.05)
+    parser.add_argument("--page_words", type=int, default=3000)
+    parser.add_argument("--tool_cache", action="store_true", help="keep the search and page caches enabled")
+    parser.add_argument("--trace_memory", action="store_true", help="record the peak of python allocations")
+    parser.add_argument("--output", "-o", help="write the report as json")
+    parser.add_argument("--baseline", help="json report to compare against, exits with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown against the baseline")
+    args = parser.parse_args()
+
+    names = WORKLOADS if args.workloads == "all" else [name.strip() for name in args.workloads.split(",")]
+    server = start_server(
+        token_rate=args.token_rate, ttft=args.ttft, answer_tokens=args.answer_tokens,
+        search_latency=args.search_latency, page_latency=args.page_latency, page_words=args.page_words
+    )
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    workdir = Path(tempfile.mkdtemp(prefix="nbpilot-bench-"))
+    os.environ["NBPILOT_CONFIG"] = str(write_config(base_url, workdir, args.tool_cache))
+    sys.path.insert(0, str(ROOT))
+
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    workloads, setups = create_workloads(args.pages)
+    reports = []
+    with open(os.devnull, "w") as devnull:
+        for name in names:
+            if name not in workloads:
+                print(f"unknown workload {name}", file=sys.stderr)
+                continue
+            with contextlib.redirect_stdout(devnull):
+                if name in setups:
+                    setups[name]()
+                report = run_workload(name, workloads[name], args.iterations, args.concurrency,
+                                      args.warmup, args.trace_memory)
+            reports.append(report)
+    server.shutdown()
+
+    print_report(reports)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fo:
+            json.dump(reports, fo, indent=2)
+    if args.baseline:
+        regressions = compare(reports, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
+from .embeddings import preload_embedding
 from .magics import NbpilotMagics
 
 
 def load_ipython_extension(ipython):
     ipython.register_magics(NbpilotMagics)
+    preload_embedding()
@@ -4,6 +4,7 @@ import re
 from loguru import logger
 
 from .llm import get_response
+from .prompt import get_prompt_budget, pack_messages
 
 
 agent_sys_prompt = """## Role
@@ -122,7 +123,7 @@ class Agent:
         errors = 0
         response = None
         while errors < max_errors:
-            response = get_response(query, history=self.history, stream=False, 
+            response = get_response(history=self._pack_history(query, provider, model), stream=False,
                                     provider=provider, model=model, debug=debug)
             tool_usage = self._parse_tool_usage(response)
             tool_output = None
@@ -142,6 +143,10 @@ class Agent:
 
         return response
 
+    def _pack_history(self, query, provider, model):
+        max_tokens, model_name = get_prompt_budget(provider, model)
+        return pack_messages(self.history + [{"role": "user", "content": query}], max_tokens, model_name)
+
     def reset(self):
         self.history = [{"role": "system", "content": self.sys_prompt}]
 
@@ -216,7 +221,7 @@ class AssistedAgent(Agent):
         errors = 0
         response = None
         while errors < max_errors:
-            response = get_response(query, history=self.history, stream=False, 
+            response = get_response(history=self._pack_history(query, provider, model), stream=False,
                                     provider=provider, model=model, debug=debug)
             print(response)
             tool_usage = self._parse_tool_usage(response)
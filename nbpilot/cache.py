@@ -0,0 +1,107 @@
+from pathlib import Path
+import sqlite3
+import threading
+import time
+
+from .config import load_config
+
+
+def get_cache_path(name):
+    config = load_config()
+    cache_dir = Path(config.get("cache_dir", "~/.nbpilot/cache")).expanduser()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir / name
+
+
+class DiskCache:
+    def __init__(self, path, max_entries=100000, ttl=None, max_bytes=None):
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB, created_at REAL, accessed_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries(accessed_at)")
+
+    def _expired(self, created_at, now):
+        return self.ttl is not None and created_at + self.ttl < now
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        now = time.time()
+        result = {}
+        expired = []
+        with self._lock, self._conn:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i+500]
+                rows = self._conn.execute(
+                    f"SELECT key, value, created_at FROM entries WHERE key IN ({','.join('?' * len(batch))})",
+                    batch
+                ).fetchall()
+                for key, value, created_at in rows:
+                    if self._expired(created_at, now):
+                        expired.append(key)
+                    else:
+                        result[key] = value
+            if expired:
+                self._conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in expired])
+            if result:
+                self._conn.executemany(
+                    "UPDATE entries SET accessed_at = ? WHERE key = ?", [(now, key) for key in result]
+                )
+        return result
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                [(key, value, now, now) for key, value in items.items()]
+            )
+            self._evict()
+
+    def delete(self, key):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM entries")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def _evict(self):
+        if self.max_entries is not None:
+            count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM entries WHERE key IN "
+                    "(SELECT key FROM entries ORDER BY accessed_at LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+        if self.max_bytes is not None:
+            total = self._conn.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            evicted = []
+            for key, size in self._conn.execute("SELECT key, LENGTH(value) FROM entries ORDER BY accessed_at"):
+                evicted.append((key,))
+                total -= size or 0
+                if total <= self.max_bytes:
+                    break
+            self._conn.executemany("DELETE FROM entries WHERE key = ?", evicted)
@@ -1,4 +1,5 @@
 import json
+import os
 from pathlib import Path
 
 
@@ -9,7 +10,7 @@ def load_config():
     global config
     if config is None:
         path = Path(__file__)
-        config_file_path = path.parent.parent / "config/config.json"
+        config_file_path = os.environ.get("NBPILOT_CONFIG") or path.parent.parent / "config/config.json"
         with open(config_file_path, encoding="utf-8") as fi:
             config = json.load(fi)
 
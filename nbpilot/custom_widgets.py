@@ -1,17 +1,51 @@
+import time
+
 import ipywidgets as widgets
 import markdown
 
 
 class AdaptableTextArea(widgets.Textarea):
-    def __init__(self, value='', **kwargs):
+    def __init__(self, value='', max_height=300, **kwargs):
         super().__init__(value=value, **kwargs)
-        self.observe(self.on_change)
-        self.max_height = kwargs.get("max_height", 300)
+        self.max_height = max_height
+        self.observe(self.on_change, names="value")
 
     def on_change(self, _):
         value_len = len(self.value)
-        height = min(((value_len // 100) + 1) * 30, self.max_height)
-        self.layout.height = f"{height}px"
+        height = f"{min(((value_len // 100) + 1) * 30, self.max_height)}px"
+        if self.layout.height != height:
+            self.layout.height = height
+
+
+class BufferedTextWriter:
+    def __init__(self, widget, interval=0.1, max_chars=4096):
+        self.widget = widget
+        self.interval = interval
+        self.max_chars = max_chars
+        self.buffer = []
+        self.buffered_chars = 0
+        self.last_flush = time.time()
+
+    def write(self, text):
+        if not text:
+            return
+        self.buffer.append(text)
+        self.buffered_chars += len(text)
+        if self.buffered_chars >= self.max_chars or time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.widget.value += "".join(self.buffer)
+            self.buffer = []
+            self.buffered_chars = 0
+        self.last_flush = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.flush()
 
 
 class ConfirmDialog(widgets.VBox):
@@ -0,0 +1,72 @@
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+
+from loguru import logger
+
+from .embeddings import LocalEmbeddings, get_embedding_config
+
+
+class EmbeddingHandler(BaseHTTPRequestHandler):
+    model = None
+    lock = threading.Lock()
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"model": self.model.model_path})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/embed":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            texts = json.loads(self.rfile.read(length))["texts"]
+        except (ValueError, KeyError):
+            self._send_json(400, {"error": "invalid request"})
+            return
+        with self.lock:
+            embeddings = self.model.embed_documents(texts)
+        self._send_json(200, {"embeddings": embeddings})
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(host, port, model_path, batch_size=32, device=None):
+    EmbeddingHandler.model = LocalEmbeddings(model_path, batch_size, device)
+    EmbeddingHandler.model.load()
+    server = ThreadingHTTPServer((host, port), EmbeddingHandler)
+    logger.info(f"embedding server listening on {host}:{port}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def main():
+    embedding_config = get_embedding_config()
+    server_config = embedding_config.get("server", {})
+    parser = argparse.ArgumentParser(prog="nbpilot-embedding-server")
+    parser.add_argument("--host", default=server_config.get("host", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=server_config.get("port", 8765))
+    parser.add_argument("--model_path", default=embedding_config.get("model_path"))
+    parser.add_argument("--batch_size", type=int, default=embedding_config.get("batch_size", 32))
+    parser.add_argument("--device", default=embedding_config.get("device"))
+    args = parser.parse_args()
+    serve(args.host, args.port, args.model_path, args.batch_size, args.device)
+
+
+if __name__ == "__main__":
+    main()
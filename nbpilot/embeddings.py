@@ -0,0 +1,181 @@
+from array import array
+import hashlib
+import math
+import threading
+
+from langchain_core.embeddings import Embeddings
+from loguru import logger
+import requests
+
+from .cache import DiskCache, get_cache_path
+from .config import load_config
+from .tracing import span
+
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class LocalEmbeddings(Embeddings):
+    def __init__(self, model_path, batch_size=32, device=None):
+        self.model_path = model_path
+        self.batch_size = batch_size
+        self.device = device
+        self._model = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._model is None:
+                import torch
+                from sentence_transformers import SentenceTransformer
+
+                device = self.device or ("cuda" if torch.cuda.is_available() else "cpu")
+                logger.info(f"loading embedding model {self.model_path} on {device}")
+                self._model = SentenceTransformer(self.model_path, device=device)
+        return self._model
+
+    def embed_documents(self, texts):
+        model = self.load()
+        texts = list(texts)
+        with span("embedding", backend="local", model=self.model_path, texts=len(texts)):
+            embeddings = model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True)
+        return embeddings.tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class RemoteEmbeddings(Embeddings):
+    def __init__(self, url, batch_size=32, timeout=60):
+        self.url = url.rstrip("/")
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        embeddings = []
+        with span("embedding", backend="server", model=self.url, texts=len(texts)):
+            for i in range(0, len(texts), self.batch_size):
+                response = self.session.post(
+                    self.url + "/embed", json={"texts": texts[i:i+self.batch_size]}, timeout=self.timeout
+                )
+                response.raise_for_status()
+                embeddings.extend(response.json()["embeddings"])
+        return embeddings
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def get_model(self):
+        response = self.session.get(self.url + "/health", timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["model"]
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embedding, cache, namespace):
+        self.embedding = embedding
+        self.cache = cache
+        self.namespace = namespace
+
+    def _key(self, text):
+        return hashlib.sha1((self.namespace + "\n" + text).encode("utf-8")).hexdigest()
+
+    def embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        cached = self.cache.get_many(set(keys))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            embeddings = self.embedding.embed_documents(list(missing.values()))
+            new_entries = {
+                key: array("f", vector).tobytes() for key, vector in zip(missing, embeddings)
+            }
+            self.cache.set_many(new_entries)
+            cached.update(new_entries)
+            logger.debug(f"{len(texts) - len(missing)} embeddings read from cache, {len(missing)} computed")
+        return [array("f", cached[key]).tolist() for key in keys]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def get_embedding_config():
+    config = load_config()
+    return config.get("rag", {}).get("embedding", {})
+
+
+def create_embedding(embedding_config):
+    backend = embedding_config.get("backend", "local")
+    batch_size = embedding_config.get("batch_size", 32)
+    if backend == "server":
+        server_config = embedding_config.get("server", {})
+        url = server_config.get("url") or \
+            f"http://{server_config.get('host', '127.0.0.1')}:{server_config.get('port', 8765)}"
+        return RemoteEmbeddings(url, batch_size, server_config.get("timeout", 60))
+    if backend == "local":
+        return LocalEmbeddings(embedding_config["model_path"], batch_size, embedding_config.get("device"))
+    raise ValueError(f"unknown embedding backend {backend}")
+
+
+embedding = None
+embedding_lock = threading.Lock()
+
+
+def get_embedding():
+    global embedding
+    with embedding_lock:
+        if embedding is None:
+            embedding_config = get_embedding_config()
+            embedding = create_embedding(embedding_config)
+            cache_config = embedding_config.get("cache", {})
+            namespace = get_cache_namespace(embedding, embedding_config)
+            if cache_config.get("enabled", True) and namespace is not None:
+                cache = DiskCache(
+                    cache_config.get("path") or get_cache_path("embeddings.sqlite"),
+                    max_entries=cache_config.get("max_entries", 200000)
+                )
+                embedding = CachedEmbeddings(embedding, cache, namespace)
+    return embedding
+
+
+def get_cache_namespace(embedding, embedding_config):
+    if not isinstance(embedding, RemoteEmbeddings):
+        return embedding_config.get("model_path", "")
+    try:
+        return f"{embedding.url}|{embedding.get_model()}"
+    except (requests.RequestException, ValueError, KeyError) as e:
+        logger.warning(f"fail to get the model of embedding server {embedding.url}, embedding cache disabled: {e}")
+        return None
+
+
+def preload_embedding():
+    if not get_embedding_config().get("preload", False):
+        return None
+    model = get_embedding()
+    if isinstance(model, CachedEmbeddings):
+        model = model.embedding
+    if not isinstance(model, LocalEmbeddings):
+        return None
+    thread = threading.Thread(target=model.load, name="nbpilot-embedding-loader", daemon=True)
+    thread.start()
+    return thread
+
+
+rerankers = {}
+
+
+def get_reranker(model_path):
+    with embedding_lock:
+        if model_path not in rerankers:
+            from sentence_transformers import CrossEncoder
+
+            logger.info(f"loading rerank model {model_path}")
+            rerankers[model_path] = CrossEncoder(model_path)
+    return rerankers[model_path]
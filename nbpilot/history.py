@@ -0,0 +1,90 @@
+from collections import deque
+import hashlib
+
+from loguru import logger
+
+from .llm import get_response
+
+
+summary_prompt = """Update the summary of an earlier conversation between a user and an AI assistant with one more turn.
+Keep the facts, decisions and code names that may be referred to later. Write no more than 200 words.
+
+Current summary:
+{summary}
+
+New turn:
+User: {user}
+Assistant: {assistant}
+
+Updated summary:"""
+
+
+class HistoryStore:
+    def __init__(self, max_turns=50, summarize=False):
+        self.turns = deque()
+        self.max_turns = max_turns
+        self.summarize = summarize
+        self.blobs = {}
+        self.summary = None
+
+    def __len__(self):
+        return len(self.turns)
+
+    def _intern(self, content):
+        if content is None:
+            return None
+        key = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        if key in self.blobs:
+            self.blobs[key][1] += 1
+        else:
+            self.blobs[key] = [content, 1]
+        return key
+
+    def _release(self, key):
+        if key is None:
+            return
+        self.blobs[key][1] -= 1
+        if self.blobs[key][1] == 0:
+            del self.blobs[key]
+
+    def add_turn(self, user, assistant, context=None, provider=None, model=None):
+        self.turns.append({"user": user, "context": self._intern(context), "assistant": assistant})
+        while len(self.turns) > self.max_turns:
+            turn = self.turns.popleft()
+            self._release(turn["context"])
+            if self.summarize:
+                self._summarize(turn, provider, model)
+
+    def _summarize(self, turn, provider, model):
+        prompt = summary_prompt.format(
+            summary=self.summary or "(empty)", user=turn["user"], assistant=turn["assistant"]
+        )
+        try:
+            self.summary = get_response(prompt, provider=provider, model=model)
+        except Exception as e:
+            logger.warning(f"fail to summarize history: {e}")
+
+    def last_turns(self, n):
+        n = min(n, len(self.turns))
+        return [self.turns[i] for i in range(len(self.turns) - n, len(self.turns))]
+
+    def get_messages(self, n, include_context=True, context=None):
+        messages = []
+        turns = self.last_turns(n) if n > 0 else []
+        if self.summary and n > len(self.turns):
+            messages.append({"role": "system", "content": "Summary of the earlier conversation:\n" + self.summary})
+        last_context = None
+        for turn in turns:
+            messages.append({"role": "user", "content": turn["user"]})
+            if include_context and turn["context"] is not None and turn["context"] != last_context:
+                messages.append({"role": "system", "content": self.blobs[turn["context"]][0]})
+                last_context = turn["context"]
+            messages.append({"role": "assistant", "content": turn["assistant"]})
+        if context is not None and (last_context is None or self.blobs.get(last_context, [None])[0] != context):
+            messages.append({"role": "system", "content": context})
+        return messages
+
+    def clear(self):
+        self.turns.clear()
+        self.blobs.clear()
+        self.summary = None
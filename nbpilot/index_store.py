@@ -0,0 +1,73 @@
+import json
+import os
+from pathlib import Path
+import time
+
+from langchain.vectorstores.chroma import Chroma
+
+from .config import load_config
+from .keyword_index import BM25Index
+
+
+INDEX_META_FILE = "index.json"
+KEYWORD_INDEX_FILE = "keywords.json"
+
+
+def get_index_root():
+    config = load_config()
+    index_dir = config.get("rag", {}).get("index_dir", "~/.nbpilot/indexes")
+    return Path(index_dir).expanduser()
+
+
+def get_index_path(index_name):
+    return get_index_root() / index_name
+
+
+def load_index_meta(index_name):
+    meta_path = get_index_path(index_name) / INDEX_META_FILE
+    if not meta_path.exists():
+        return None
+    with open(meta_path, encoding="utf-8") as fi:
+        return json.load(fi)
+
+
+def save_index_meta(index_name, meta):
+    index_path = get_index_path(index_name)
+    index_path.mkdir(parents=True, exist_ok=True)
+    meta = dict(load_index_meta(index_name) or {}, **meta)
+    meta.update(name=index_name, updated_at=time.time())
+    tmp_path = index_path / (INDEX_META_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as fo:
+        json.dump(meta, fo, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, index_path / INDEX_META_FILE)
+
+
+def has_index(index_name, url=None):
+    meta = load_index_meta(index_name)
+    if meta is None:
+        return False
+    return url is None or url in meta.get("sources", [])
+
+
+def open_index(index_name, embedding):
+    index_path = get_index_path(index_name)
+    index_path.mkdir(parents=True, exist_ok=True)
+    return Chroma(
+        collection_name=index_name,
+        embedding_function=embedding,
+        persist_directory=str(index_path),
+        collection_metadata={"hnsw:space": "cosine"}
+    )
+
+
+def load_keyword_index(index_name):
+    keyword_index_path = get_index_path(index_name) / KEYWORD_INDEX_FILE
+    if not keyword_index_path.exists():
+        return None
+    return BM25Index.load(keyword_index_path)
+
+
+def save_keyword_index(index_name, keyword_index):
+    index_path = get_index_path(index_name)
+    index_path.mkdir(parents=True, exist_ok=True)
+    keyword_index.save(index_path / KEYWORD_INDEX_FILE)
@@ -4,7 +4,7 @@ from IPython import get_ipython
 from IPython.display import display
 import ipywidgets as widgets
 
-from .custom_widgets import AdaptableTextArea, ConfirmDialog
+from .custom_widgets import AdaptableTextArea, BufferedTextWriter, ConfirmDialog
 from .llm import get_response
 
 
@@ -72,12 +72,13 @@ class Inpteracter:
         self.msg_widgets.append(response_widget)
         with self.output_context:
             display(response_widget)
-        for chunk in res:
-            if not chunk.choices:
-                continue
-            chunk_content = chunk.choices[0].delta.content
-            if chunk_content is not None:
-                response_widget.value += chunk_content
+        with BufferedTextWriter(response_widget) as writer:
+            for chunk in res:
+                if not chunk.choices:
+                    continue
+                chunk_content = chunk.choices[0].delta.content
+                if chunk_content is not None:
+                    writer.write(chunk_content)
         response = response_widget.value
         codeblocks = self._extract_code_blocks(response)
         buttons = []
@@ -0,0 +1,203 @@
+from collections import OrderedDict
+import itertools
+import sys
+import threading
+import time
+import traceback
+
+from IPython import get_ipython
+from IPython.display import display
+import ipywidgets as widgets
+from loguru import logger
+
+from .config import load_config
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, job_id, description, flush_interval=0.1):
+        self.id = job_id
+        self.description = description
+        self.flush_interval = flush_interval
+        self.output = widgets.Output()
+        self.status = "pending"
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self.thread = None
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock()
+        self.stdout_buffer = []
+        self.last_flush = 0
+        self.display_indexes = {}
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def write(self, text):
+        with self.lock:
+            self.stdout_buffer.append(text)
+            if time.time() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.last_flush = time.time()
+        if not self.stdout_buffer:
+            return
+        text = "".join(self.stdout_buffer)
+        self.stdout_buffer = []
+        outputs = self.output.outputs
+        if outputs and outputs[-1].get("output_type") == "stream" and outputs[-1].get("name") == "stdout":
+            last = dict(outputs[-1], text=outputs[-1]["text"] + text)
+            self.output.outputs = outputs[:-1] + (last,)
+        else:
+            self.output.outputs = outputs + ({"output_type": "stream", "name": "stdout", "text": text},)
+
+    def publish(self, data, metadata=None, transient=None, update=False):
+        output = {"output_type": "display_data", "data": data, "metadata": metadata or {}}
+        display_id = (transient or {}).get("display_id")
+        with self.lock:
+            self._flush()
+            outputs = self.output.outputs
+            if update:
+                index = self.display_indexes.get(display_id)
+                if index is not None:
+                    self.output.outputs = outputs[:index] + (output,) + outputs[index+1:]
+                return
+            if display_id is not None:
+                self.display_indexes[display_id] = len(outputs)
+            self.output.outputs = outputs + (output,)
+
+    def run(self, func):
+        current.job = self
+        self.status = "running"
+        self.started_at = time.time()
+        try:
+            func()
+            self.status = "done"
+        except JobCancelled:
+            self.status = "cancelled"
+            self.write("\n[cancelled]\n")
+        except Exception as e:
+            self.status = "failed"
+            self.error = e
+            self.write("".join(traceback.format_exception(type(e), e, e.__traceback__)))
+            logger.warning(f"job {self.id} failed: {e}")
+        finally:
+            self.finished_at = time.time()
+            self.flush()
+            current.job = None
+
+
+class JobStdout:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        job = current_job()
+        if job is None:
+            return self.stream.write(text)
+        job.write(text)
+        return len(text)
+
+    def flush(self):
+        job = current_job()
+        if job is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+current = threading.local()
+jobs = OrderedDict()
+jobs_lock = threading.Lock()
+job_ids = itertools.count(1)
+hooks_installed = False
+
+
+def current_job():
+    return getattr(current, "job", None)
+
+
+def raise_if_cancelled():
+    job = current_job()
+    if job is not None and job.cancelled:
+        raise JobCancelled()
+
+
+def cancellable(response):
+    if current_job() is None:
+        return response
+    return iter_cancellable(response)
+
+
+def iter_cancellable(response):
+    try:
+        for chunk in response:
+            raise_if_cancelled()
+            yield chunk
+    finally:
+        close = getattr(response, "close", None)
+        if close is not None:
+            close()
+
+
+def install_hooks():
+    global hooks_installed
+    if hooks_installed:
+        return
+    display_pub = get_ipython().display_pub
+    publish = display_pub.publish
+
+    def job_publish(data, metadata=None, *args, transient=None, update=False, **kwargs):
+        job = current_job()
+        if job is None:
+            return publish(data, metadata, *args, transient=transient, update=update, **kwargs)
+        job.publish(data, metadata, transient, update)
+
+    display_pub.publish = job_publish
+    sys.stdout = JobStdout(sys.stdout)
+    hooks_installed = True
+
+
+def start_job(func, description):
+    install_hooks()
+    jobs_config = load_config().get("jobs", {})
+    job = Job(next(job_ids), description, jobs_config.get("flush_interval", 0.1))
+    with jobs_lock:
+        jobs[job.id] = job
+        finished = [job_id for job_id, j in jobs.items() if j.finished_at is not None]
+        for job_id in finished[:max(len(finished) - jobs_config.get("max_finished_jobs", 20), 0)]:
+            del jobs[job_id]
+    display(job.output)
+    job.thread = threading.Thread(target=job.run, args=(func,), name=f"nbpilot-job-{job.id}", daemon=True)
+    job.thread.start()
+    return job
+
+
+def cancel_jobs(job_ids=None):
+    with jobs_lock:
+        targets = [jobs[job_id] for job_id in job_ids if job_id in jobs] if job_ids else list(jobs.values())
+    cancelled = []
+    for job in targets:
+        if job.finished_at is None:
+            job.cancel()
+            cancelled.append(job.id)
+    return cancelled
+
+
+def list_jobs():
+    with jobs_lock:
+        return list(jobs.values())
@@ -0,0 +1,92 @@
+from collections import Counter
+import json
+import math
+import os
+import re
+
+
+TOKEN_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_.]*[A-Za-z0-9_]|[A-Za-z0-9_]+|[一-鿿]")
+
+
+def tokenize(text):
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text.lower()):
+        token = match.group(0)
+        tokens.append(token)
+        if "." in token or "_" in token:
+            tokens.extend(part for part in re.split(r"[._]", token) if part)
+    return tokens
+
+
+class BM25Index:
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.doc_lens = {}
+        self.doc_terms = {}
+        self.total_len = 0
+
+    def __len__(self):
+        return len(self.doc_lens)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_lens
+
+    def add(self, doc_id, text):
+        if doc_id in self.doc_lens:
+            self.remove(doc_id)
+        term_freqs = Counter(tokenize(text))
+        for term, freq in term_freqs.items():
+            self.postings.setdefault(term, {})[doc_id] = freq
+        self.doc_terms[doc_id] = list(term_freqs)
+        doc_len = sum(term_freqs.values())
+        self.doc_lens[doc_id] = doc_len
+        self.total_len += doc_len
+
+    def remove(self, doc_id):
+        doc_len = self.doc_lens.pop(doc_id, None)
+        if doc_len is None:
+            return
+        self.total_len -= doc_len
+        for term in self.doc_terms.pop(doc_id, []):
+            posting = self.postings.get(term, {})
+            posting.pop(doc_id, None)
+            if not posting:
+                self.postings.pop(term, None)
+
+    def search(self, query, k=10):
+        if not self.doc_lens:
+            return []
+        n_docs = len(self.doc_lens)
+        avg_len = self.total_len / n_docs
+        scores = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, freq in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lens[doc_id] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0) + idf * freq * (self.k1 + 1) / (freq + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def save(self, path):
+        data = {"k1": self.k1, "b": self.b, "postings": self.postings, "doc_lens": self.doc_lens}
+        tmp_path = str(path) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fo:
+            json.dump(data, fo, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as fi:
+            data = json.load(fi)
+        index = cls(data["k1"], data["b"])
+        index.postings = data["postings"]
+        index.doc_lens = data["doc_lens"]
+        index.total_len = sum(index.doc_lens.values())
+        for term, posting in index.postings.items():
+            for doc_id in posting:
+                index.doc_terms.setdefault(doc_id, []).append(term)
+        return index
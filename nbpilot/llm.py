@@ -1,11 +1,14 @@
-import copy
+import asyncio
 import json
+import threading
+import time
+import weakref
 
 import dashscope 
-from litellm import completion
+from litellm import acompletion, completion
 from litellm.utils import Choices, Delta, Message, ModelResponse, StreamingChoices
 from loguru import logger
-from openai import OpenAI
+from openai import AsyncOpenAI, AsyncStream, OpenAI
 from openai.resources.chat.completions import ChatCompletion, ChatCompletionChunk, Stream
 from tencentcloud.common import credential
 from tencentcloud.common.profile.client_profile import ClientProfile
@@ -14,17 +17,20 @@ from tencentcloud.common.exception.tencent_cloud_sdk_exception import TencentClo
 from tencentcloud.hunyuan.v20230901 import hunyuan_client, models
 
 from .config import load_config
+from .jobs import JobCancelled, cancellable, raise_if_cancelled
+from .prompt import count_tokens
+from .rate_limit import AsyncLeasedStream, LeasedStream, get_rate_limiter
+from .resilience import (
+    aguard_stream, arun_candidates, awith_retries, get_candidates, get_policy, get_timeout, guard_stream,
+    run_candidates, with_retries
+)
+from .response_cache import (
+    arecord_stream, areplay_stream, get_response_cache, is_cache_enabled, record_stream, replay_stream
+)
+from .tracing import atrace_stream, set_usage, start_span, trace_stream
 
 
-def get_response(
-        user_prompt=None,
-        system_prompt=None,
-        history=None,
-        stream=False,
-        provider="qwen",
-        model=None,
-        debug=False):
-    config = load_config()
+def build_messages(user_prompt=None, system_prompt=None, history=None):
     messages = []
     if system_prompt:
         messages.append({"role": "system", "content": system_prompt})
@@ -32,46 +38,323 @@ def get_response(
         messages.append({"role": "user", "content": user_prompt})
     if history:
         messages = history + messages
+    return messages
+
 
+def get_llm_config(provider, model=None):
+    config = load_config()
+    llm_config = dict(config["llm"][provider])
+    if model:
+        llm_config["model_name"] = model
+    return llm_config
+
+
+def get_response(
+        user_prompt=None,
+        system_prompt=None,
+        history=None,
+        stream=False,
+        provider="qwen",
+        model=None,
+        debug=False,
+        cache=None):
+    raise_if_cancelled()
+    messages = build_messages(user_prompt, system_prompt, history)
     if debug:
         logger.debug(json.dumps(messages, ensure_ascii=False))
 
-    llm_config = copy.deepcopy(config["llm"][provider])
-    if model:
-        llm_config["model"] = model
+    llm_config = get_llm_config(provider, model)
+    if cache is None:
+        cache = is_cache_enabled()
+    response_cache = get_response_cache() if cache else None
+    model_name = llm_config.get("model_name")
+    llm_span = start_llm_span(provider, model_name, messages, stream)
+    token_counter = lambda text: count_tokens(text, model_name)
+    if response_cache is not None:
+        content = response_cache.get(provider, model_name, messages)
+        if content is not None:
+            llm_span.set(cache_hit=True)
+            if stream:
+                return cancellable(trace_stream(replay_stream(content), llm_span, token_counter))
+            set_usage(llm_span, None, content, token_counter)
+            llm_span.end()
+            return content
+
+    try:
+        provider_used, response = request_with_policy(provider, model, messages, stream)
+        cache_model = model_name
+        if provider_used != provider:
+            llm_span.set(failover_provider=provider_used)
+            cache_model = get_llm_config(provider_used).get("model_name")
+        if not stream:
+            content = response.choices[0].message.content
+            set_usage(llm_span, getattr(response, "usage", None), content, token_counter)
+    except Exception as e:
+        llm_span.end(e)
+        raise
+    if not stream:
+        llm_span.end()
+        if response_cache is not None:
+            response_cache.put(provider_used, cache_model, messages, content)
+        return content
+    if response_cache is not None:
+        response = record_stream(
+            response, lambda content: response_cache.put(provider_used, cache_model, messages, content)
+        )
+    return cancellable(trace_stream(response, llm_span, token_counter))
+
+
+def start_llm_span(provider, model_name, messages, stream):
+    prompt_tokens = sum(count_tokens(message["content"], model_name) for message in messages
+                        if isinstance(message["content"], str))
+    return start_span("llm.response", provider=provider, model=model_name, stream=stream,
+                      prompt_tokens=prompt_tokens)
+
 
+def request_with_policy(provider, model, messages, stream):
+    policy = get_policy(provider)
+    deadline = time.time() + policy["total_timeout"]
+
+    def attempt(candidate, stop):
+        llm_config = get_llm_config(candidate, model if candidate == provider else None)
+        candidate_policy = get_policy(candidate)
+
+        def request():
+            lease, count_used = acquire_lease(candidate, llm_config, messages, deadline, stop)
+            try:
+                if stop.is_set():
+                    raise JobCancelled(f"request to {candidate} abandoned")
+                response = request_response(candidate, llm_config, messages, stream)
+                if stream:
+                    response = guard_stream(response, candidate_policy, deadline)
+            except BaseException:
+                if lease is not None:
+                    lease.release()
+                raise
+            if lease is None:
+                return response
+            if stream:
+                return LeasedStream(response, lease, count_used)
+            lease.release(count_used(response.choices[0].message.content or ""))
+            return response
+
+        return with_retries(request, candidate_policy, deadline, candidate, stop)
+
+    return run_candidates(get_candidates(provider, policy), attempt, policy.get("hedge_after"), deadline)
+
+
+def acquire_lease(provider, llm_config, messages, deadline=None, stop=None):
+    limiter = get_rate_limiter("llm", provider)
+    if limiter is None:
+        return None, None
+    model_name = llm_config.get("model_name")
+    prompt_tokens = sum(count_tokens(message["content"], model_name) for message in messages
+                        if isinstance(message["content"], str))
+    completion_tokens = llm_config.get(
+        "completion_tokens", load_config().get("prompt", {}).get("completion_tokens", 1500)
+    )
+    lease = limiter.acquire(prompt_tokens + completion_tokens, deadline, stop)
+    return lease, lambda content: prompt_tokens + count_tokens(content, model_name)
+
+
+async def aacquire_lease(provider, llm_config, messages, deadline=None):
+    stop = threading.Event()
+    future = asyncio.ensure_future(
+        asyncio.to_thread(acquire_lease, provider, llm_config, messages, deadline, stop)
+    )
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        stop.set()
+        future.add_done_callback(release_abandoned_lease)
+        raise
+
+
+def release_abandoned_lease(future):
+    if not future.cancelled() and future.exception() is None:
+        lease, _ = future.result()
+        if lease is not None:
+            lease.release()
+
+
+def request_response(provider, llm_config, messages, stream):
     if provider == "qwen":
-        response = get_qwen_response(llm_config, messages, stream)
+        return get_qwen_response(llm_config, messages, stream)
     elif provider == "hunyuan":
-        response = get_hunyuan_response(llm_config, messages, stream)
+        return get_hunyuan_response(llm_config, messages, stream)
     elif provider == "mini_max":
-        response = get_minimax_response(llm_config, messages, stream)
-    else:
-        response = completion(
-            base_url=llm_config["base_url"],
-            api_key=llm_config.get("api_key"),
-            api_version=llm_config.get("api_version"),
-            model=model or llm_config["model_name"],
-            messages=messages,
-            stream=stream
-        )
+        return get_minimax_response(llm_config, messages, stream)
+    return completion(
+        base_url=llm_config["base_url"],
+        api_key=llm_config.get("api_key"),
+        api_version=llm_config.get("api_version"),
+        model=llm_config["model_name"],
+        messages=messages,
+        stream=stream,
+        timeout=get_timeout(get_policy(provider), stream)
+    )
+
+
+async def aget_response(
+        user_prompt=None,
+        system_prompt=None,
+        history=None,
+        stream=False,
+        provider="qwen",
+        model=None,
+        debug=False,
+        cache=None):
+    messages = build_messages(user_prompt, system_prompt, history)
+    if debug:
+        logger.debug(json.dumps(messages, ensure_ascii=False))
+
+    llm_config = get_llm_config(provider, model)
+    if cache is None:
+        cache = is_cache_enabled()
+    response_cache = get_response_cache() if cache else None
+    model_name = llm_config.get("model_name")
+    llm_span = start_llm_span(provider, model_name, messages, stream)
+    token_counter = lambda text: count_tokens(text, model_name)
+    if response_cache is not None:
+        content = await asyncio.to_thread(response_cache.get, provider, model_name, messages)
+        if content is not None:
+            llm_span.set(cache_hit=True)
+            if stream:
+                return atrace_stream(areplay_stream(content), llm_span, token_counter)
+            set_usage(llm_span, None, content, token_counter)
+            llm_span.end()
+            return content
+
+    try:
+        provider_used, response = await arequest_with_policy(provider, model, messages, stream)
+        cache_model = model_name
+        if provider_used != provider:
+            llm_span.set(failover_provider=provider_used)
+            cache_model = get_llm_config(provider_used).get("model_name")
+        if not stream:
+            content = response.choices[0].message.content
+            set_usage(llm_span, getattr(response, "usage", None), content, token_counter)
+    except Exception as e:
+        llm_span.end(e)
+        raise
     if not stream:
-        return response.choices[0].message.content
-    return response
+        llm_span.end()
+        if response_cache is not None:
+            await asyncio.to_thread(response_cache.put, provider_used, cache_model, messages, content)
+        return content
+    if response_cache is not None:
+        response = arecord_stream(
+            response, lambda content: response_cache.put(provider_used, cache_model, messages, content)
+        )
+    return atrace_stream(response, llm_span, token_counter)
+
+
+async def arequest_with_policy(provider, model, messages, stream):
+    policy = get_policy(provider)
+    deadline = time.time() + policy["total_timeout"]
+
+    async def attempt(candidate):
+        llm_config = get_llm_config(candidate, model if candidate == provider else None)
+        candidate_policy = get_policy(candidate)
+
+        async def request():
+            lease, count_used = await aacquire_lease(candidate, llm_config, messages, deadline)
+            try:
+                response = await arequest_response(candidate, llm_config, messages, stream)
+                if stream:
+                    response = await aguard_stream(response, candidate_policy, deadline)
+            except BaseException:
+                if lease is not None:
+                    lease.release()
+                raise
+            if lease is None:
+                return response
+            if stream:
+                return AsyncLeasedStream(response, lease, count_used)
+            lease.release(count_used(response.choices[0].message.content or ""))
+            return response
+
+        return await awith_retries(request, candidate_policy, deadline, candidate)
+
+    return await arun_candidates(get_candidates(provider, policy), attempt, deadline)
+
+
+async def arequest_response(provider, llm_config, messages, stream):
+    if provider == "qwen":
+        return await aget_qwen_response(llm_config, messages, stream)
+    elif provider == "hunyuan":
+        return await aget_hunyuan_response(llm_config, messages, stream)
+    elif provider == "mini_max":
+        return await aget_minimax_response(llm_config, messages, stream)
+    return await acompletion(
+        base_url=llm_config["base_url"],
+        api_key=llm_config.get("api_key"),
+        api_version=llm_config.get("api_version"),
+        model=llm_config["model_name"],
+        messages=messages,
+        stream=stream,
+        timeout=get_timeout(get_policy(provider), stream)
+    )
+
+
+async def aiter_in_thread(iterator):
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterator)
+    end = object()
+    while True:
+        chunk = await loop.run_in_executor(None, next, iterator, end)
+        if chunk is end:
+            break
+        yield chunk
+
+
+clients = {}
+clients_lock = threading.Lock()
+
 
+def get_client(provider, llm_config, factory, registry=None):
+    registry = clients if registry is None else registry
+    key = (provider, json.dumps(
+        {k: v for k, v in llm_config.items() if k != "model_name"}, sort_keys=True, default=str
+    ))
+    with clients_lock:
+        client = registry.get(key)
+        if client is None:
+            client = factory(llm_config)
+            registry[key] = client
+    return client
 
-def get_qwen_response(llm_config, ):
+
+loop_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client(provider, llm_config, factory):
+    loop = asyncio.get_running_loop()
+    with clients_lock:
+        for closed_loop in [other for other in loop_clients if other.is_closed()]:
+            del loop_clients[closed_loop]
+        registry = loop_clients.setdefault(loop, {})
+    return get_client(provider, llm_config, factory, registry)
+
+
+def get_qwen_response(llm_config, messages, stream):
     response = dashscope.Generation.call(
         api_key=llm_config["api_key"],
         model=llm_config["model_name"],
         messages=messages,
         stream=stream,
-        result_format='message'
+        result_format='message',
+        request_timeout=get_policy("qwen")["total_timeout"]
     )
-    response = wrap_response(response) if not stream else wrap_stream_response(response)
+    response = wrap_qwen_response(response) if not stream else wrap_qwen_stream_response(response)
     return response
 
 
+async def aget_qwen_response(llm_config, messages, stream):
+    response = await asyncio.to_thread(get_qwen_response, llm_config, messages, stream)
+    return awrap_qwen_stream_response(response) if stream else response
+
+
 def wrap_qwen_response(response):
     choice = response.output.choices[0]
     message = choice.message
@@ -94,15 +377,31 @@ def wrap_qwen_stream_response(response):
         yield new_chunk
 
 
-def get_hunyuan_response(llm_config, messages, stream):
+async def awrap_qwen_stream_response(response):
+    async for chunk in aiter_in_thread(response):
+        yield chunk
+
+
+def create_hunyuan_client(llm_config):
     api_key = llm_config["api_key"]
     cred = credential.Credential(api_key["secret_id"], api_key["secret_key"])
     httpProfile = HttpProfile()
     httpProfile.endpoint = llm_config["base_url"]
+    httpProfile.keepAlive = True
+    httpProfile.reqTimeout = int(get_policy("hunyuan")["total_timeout"])
 
     clientProfile = ClientProfile()
     clientProfile.httpProfile = httpProfile
-    client = hunyuan_client.HunyuanClient(cred, "", clientProfile)
+    return hunyuan_client.HunyuanClient(cred, "", clientProfile)
+
+
+async def aget_hunyuan_response(llm_config, messages, stream):
+    response = await asyncio.to_thread(get_hunyuan_response, llm_config, messages, stream)
+    return awrap_hunyuan_stream_response(response) if stream else response
+
+
+def get_hunyuan_response(llm_config, messages, stream):
+    client = get_client("hunyuan", llm_config, create_hunyuan_client)
 
     req = models.ChatCompletionsRequest()
     new_messages = []
@@ -143,10 +442,34 @@ def wrap_hunyuan_stream_response(response):
         yield new_chunk
 
 
+async def awrap_hunyuan_stream_response(response):
+    async for chunk in aiter_in_thread(response):
+        yield chunk
+
+
+def create_openai_client(llm_config):
+    return OpenAI(base_url=llm_config["base_url"], api_key=llm_config["api_key"], max_retries=0)
+
+
+def create_async_openai_client(llm_config):
+    return AsyncOpenAI(base_url=llm_config["base_url"], api_key=llm_config["api_key"], max_retries=0)
+
+
 def get_minimax_response(llm_config, messages, stream):
-    client = OpenAI(base_url=llm_config["base_url"], api_key=llm_config["api_key"])
+    client = get_client("mini_max", llm_config, create_openai_client)
     response = client.chat.completions._post(
         "", body={"messages": messages, "model": llm_config["model_name"], "stream": stream, "max_tokens": 4096},
-        cast_to=ChatCompletion, stream=stream, stream_cls=Stream[ChatCompletionChunk]
+        cast_to=ChatCompletion, stream=stream, stream_cls=Stream[ChatCompletionChunk],
+        options={"timeout": get_timeout(get_policy("mini_max"), stream)}
+    )
+    return response
+
+
+async def aget_minimax_response(llm_config, messages, stream):
+    client = get_async_client("mini_max", llm_config, create_async_openai_client)
+    response = await client.chat.completions._post(
+        "", body={"messages": messages, "model": llm_config["model_name"], "stream": stream, "max_tokens": 4096},
+        cast_to=ChatCompletion, stream=stream, stream_cls=AsyncStream[ChatCompletionChunk],
+        options={"timeout": get_timeout(get_policy("mini_max"), stream)}
     )
     return response
@@ -1,15 +1,23 @@
 import argparse
+import time
 
 from IPython import get_ipython
 from IPython.core.magic import Magics, line_cell_magic, magics_class
 import shlex
 
 from .interactive import Inpteracter
-from .nbpilot import call_nbpilot, summarize_webpage
-from .rag import build_index_from_url, retrieve_and_answer, search_and_answer
+from .jobs import cancel_jobs, list_jobs, start_job
+from .nbpilot import call_nbpilot, notebook_context, summarize_webpage
+from .rag import build_index_from_urls, configure_retrieval, retrieve_and_answer, search_and_answer
+from .tracing import span, tracer
 
 
 RUNNING_CELL_ID = None
+RETRIEVAL_ARGS = ["k", "score_threshold", "vector_weight", "keyword_weight", "rerank"]
+
+
+def get_retrieval_args(args):
+    return {name: getattr(args, name) for name in RETRIEVAL_ARGS}
 
 
 def run(args_line=None, query=None):
@@ -21,8 +29,23 @@ def run(args_line=None, query=None):
     parent_parser.add_argument('--debug', "-d", action="store_true",
         dest="debug", help="run with debug mode")
     parent_parser.add_argument("--history_turns", "-H", required=False, help="history turns to include", type=int, default=0)
-    parent_parser.add_argument("--cells", "-c", required=False, help="cells to include in the context")
+    parent_parser.add_argument("--cells", "-c", required=False,
+        help="cells to include in the context, 'all', or 'auto[:k]' to pick the cells relevant to the query")
     parent_parser.add_argument("--query", "-q", required=False, help="query")
+    parent_parser.add_argument("--background", "-b", action="store_true",
+        help="run in a background thread and return immediately")
+
+    retrieval_parser = argparse.ArgumentParser(add_help=False)
+    retrieval_parser.add_argument("--top_k", "-k", required=False, type=int, dest="k",
+        help="number of references to retrieve")
+    retrieval_parser.add_argument("--score_threshold", required=False, type=float,
+        help="minimum similarity score of vector search results")
+    retrieval_parser.add_argument("--vector_weight", required=False, type=float,
+        help="weight of vector search in rank fusion")
+    retrieval_parser.add_argument("--keyword_weight", required=False, type=float,
+        help="weight of keyword search in rank fusion")
+    retrieval_parser.add_argument("--rerank", action=argparse.BooleanOptionalAction, default=None,
+        help="rerank retrieved references with a cross-encoder")
 
     main_parser = argparse.ArgumentParser(prog="nbpilot", parents=[parent_parser])
 
@@ -30,15 +53,24 @@ def run(args_line=None, query=None):
 
     search_parser = subparsers.add_parser("search", help="semantic search",
         parents=[parent_parser])
-    search_parser.add_argument("--search_api", default="ms", required=False, help="search api to use")
+    search_parser.add_argument("--search_api", default="ms", required=False,
+        help="search api to use, several comma separated apis or 'all' to query them concurrently")
+    search_parser.add_argument("--compress", action="store_true",
+        help="rank references against the query and keep the best within the token budget")
+    search_parser.add_argument("--pages", required=False, type=int,
+        help="number of top result pages to fetch and split into references")
 
     read_parser = subparsers.add_parser("read", help="read a web page or file to create index",
-        parents=[parent_parser])
-    read_parser.add_argument("--url", required=False, help="the url of a web page")
+        parents=[parent_parser, retrieval_parser])
+    read_parser.add_argument("--url", required=False, nargs="+", help="the urls of web pages")
+    read_parser.add_argument("--sitemap", required=False, help="the url of a sitemap listing pages to read")
+    read_parser.add_argument("--depth", required=False, type=int, default=0, help="depth of links to follow from the pages")
+    read_parser.add_argument("--workers", required=False, type=int, default=8, help="number of pages fetched concurrently")
     read_parser.add_argument("--index-name", "-i", required=False, help="the name of the index")
+    read_parser.add_argument("--refresh", "-r", action="store_true", help="rebuild the index even if it exists")
 
     ask_parser = subparsers.add_parser("ask", help="read a web page or file to create index",
-        parents=[parent_parser])
+        parents=[parent_parser, retrieval_parser])
     ask_parser.add_argument("--index_name", "-i", required=False, help="the name of the index")
 
     summarize_parser = subparsers.add_parser("summarize", help="summarize the content of a web page or a file",
@@ -46,10 +78,23 @@ def run(args_line=None, query=None):
     summarize_parser.add_argument("--url", required=False, help="the url of a web page")
     summarize_parser.add_argument("--words", required=False, help="number of words", type=int, default=200)
     summarize_parser.add_argument("--lang", "-l", required=False, help="language", default="Chinese")
+    summarize_parser.add_argument("--map_reduce", action=argparse.BooleanOptionalAction, default=None,
+        help="summarize chunks concurrently and combine the summaries, by default only for long pages")
+    summarize_parser.add_argument("--concurrency", required=False, type=int,
+        help="max number of chunks summarized at once")
 
     interact_parser = subparsers.add_parser("interact", help="run in interactive mode",
         parents=[parent_parser])
 
+    jobs_parser = subparsers.add_parser("jobs", help="list background jobs")
+
+    cancel_parser = subparsers.add_parser("cancel", help="cancel background jobs")
+    cancel_parser.add_argument("job_ids", nargs="*", type=int, help="ids of the jobs to cancel, all jobs by default")
+
+    stats_parser = subparsers.add_parser("stats", help="show latency and token statistics of recorded spans")
+    stats_parser.add_argument("--export", required=False, help="write the recorded spans to a jsonl file")
+    stats_parser.add_argument("--reset", action="store_true", help="clear the recorded spans")
+
     try:
         if args_line is not None:
             args = main_parser.parse_args(shlex.split(args_line) if args_line else [])
@@ -61,30 +106,77 @@ def run(args_line=None, query=None):
         main_parser.print_help()
         return
 
+    if args.sub_command == "jobs":
+        for job in list_jobs():
+            elapsed = (job.finished_at or time.time()) - job.started_at if job.started_at else 0
+            print(f"[{job.id}] {job.status:<9} {elapsed:7.1f}s  {job.description}")
+        return
+    elif args.sub_command == "cancel":
+        cancelled = cancel_jobs(args.job_ids)
+        print(f"cancelling jobs: {', '.join(map(str, cancelled))}" if cancelled else "no running jobs")
+        return
+    elif args.sub_command == "stats":
+        show_stats(args.export, args.reset)
+        return
+    elif args.sub_command == "interact":
+        interacter = Inpteracter(args.provider, args.model)
+        return interacter.interact()
+
+    if args.sub_command in (None, "search", "ask") and query is None:
+        main_parser.print_help()
+        return
+    cell_id = RUNNING_CELL_ID
+    if args.background and get_ipython() is not None:
+        description = f"{args.sub_command or 'chat'}: {query or args_line}"
+        start_job(lambda: execute(args, query, cell_id), description[:80])
+    else:
+        execute(args, query, cell_id)
+
+
+def execute(args, query, cell_id):
+    with span(f"nbpilot.{args.sub_command or 'chat'}", provider=args.provider, model=args.model):
+        dispatch(args, query, cell_id)
+
+
+def dispatch(args, query, cell_id):
     if args.sub_command is None:
-        if query is None:
-            main_parser.print_help()
-            return
-        call_nbpilot(query, RUNNING_CELL_ID, provider=args.provider, model=args.model,
+        call_nbpilot(query, cell_id, provider=args.provider, model=args.model,
                      history_turns=args.history_turns, context_cells=args.cells, debug=args.debug)
-
     elif args.sub_command == "search":
-        if query is None:
-            main_parser.print_help()
-            return
-        search_and_answer([], query, provider=args.provider, model=args.model, debug=args.debug)
+        search_and_answer([], query, compress_context=args.compress, provider=args.provider, model=args.model,
+                          debug=args.debug, engine=args.search_api, enrich_pages=args.pages)
     elif args.sub_command == "read":
-        build_index_from_url(args.url, args.index_name)
+        build_index_from_urls(args.url, args.index_name, args.sitemap, args.depth, args.refresh,
+                              max_workers=args.workers)
+        configure_retrieval(args.index_name, **get_retrieval_args(args))
     elif args.sub_command == "ask":
-        if query is None:
-            main_parser.print_help()
-            return
-        retrieve_and_answer(query, args.index_name, args.provider, args.model, args.debug)
+        retrieve_and_answer(query, args.index_name, args.provider, args.model, args.debug,
+                            **get_retrieval_args(args))
     elif args.sub_command == "summarize":
-        summarize_webpage(args.url, args.lang, args.words, args.provider, args.model, args.debug)
-    elif args.sub_command == "interact":
-        interacter = Inpteracter(args.provider, args.model)
-        return interacter.interact()
+        summarize_webpage(args.url, args.lang, args.words, args.provider, args.model, args.debug,
+                          map_reduce=args.map_reduce, max_concurrency=args.concurrency)
+
+
+def show_stats(export=None, reset=False):
+    rows = tracer.stats()
+    if not rows:
+        print("no spans recorded")
+    else:
+        print(f"{'span':<24} {'provider':<10} {'model':<28} {'count':>5} {'err':>3} {'total':>8} {'p50':>7} "
+              f"{'p95':>7} {'ttft':>6} {'tok/s':>7} {'prompt':>8} {'compl':>7}")
+    for row in rows:
+        print(f"{row['name']:<24} {row['provider'] or '-':<10} {str(row['model'] or '-')[-28:]:<28} "
+              f"{row['count']:>5} {row['errors']:>3} {row['total']:>7.2f}s {row['p50']:>6.2f}s {row['p95']:>6.2f}s "
+              f"{format_number(row['ttft'], 's'):>6} {format_number(row['tokens_per_second']):>7} "
+              f"{row['prompt_tokens']:>8} {row['completion_tokens']:>7}")
+    if export:
+        print(f"{tracer.dump(export)} spans written to {export}")
+    if reset:
+        tracer.clear()
+
+
+def format_number(value, unit=""):
+    return f"{value:.1f}{unit}" if value is not None else "-"
 
 
 @magics_class
@@ -101,5 +193,7 @@ def pre_run_cell(info):
 
 try:
     get_ipython().events.register('pre_run_cell', pre_run_cell)
+    get_ipython().events.register('pre_run_cell', notebook_context.on_pre_run_cell)
+    get_ipython().events.register('post_run_cell', notebook_context.on_post_run_cell)
 except:
     pass
\ No newline at end of file
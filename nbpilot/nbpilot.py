@@ -1,12 +1,21 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import json
 import platform
 import re
 import time
 
 from ipylab import JupyterFrontEnd
-import ipynbname
-import nbformat
+from loguru import logger
 
+from .config import load_config
+from .history import HistoryStore
 from .llm import get_response
+from .notebook_context import NotebookContext
+from .prompt import (
+    PromptPacker, count_tokens, get_prompt_budget, pack_messages, split_text, truncate_text
+)
 from .tools import fetch_webpage_content
 
 
@@ -25,21 +34,12 @@ Current time: {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}
 app = JupyterFrontEnd()
 
 
-def get_latest_notebook_content(cell_id):
-    app.commands.execute('docmanager:save')
-    time.sleep(1)
-
-    notebook_path = ipynbname.path()
-    with open(notebook_path, encoding="utf-8") as fi:
-        notebook = nbformat.read(fi, as_version=4)
-    cells = []
-    current_cell_index = None
-    for i, cell in enumerate(notebook.cells):
-        cells.append(format_cell_content(cell, i))
-        if cell.id == cell_id:
-            current_cell_index = i + 1
-
-    return {"cells": cells, "current_cell_index": current_cell_index}
+context_config = load_config().get("context", {})
+notebook_context = NotebookContext(
+    app,
+    save_timeout=context_config.get("save_timeout", 1.0),
+    index_cells_on_run=context_config.get("index_cells_on_run", False)
+)
 
 
 def parse_range(context_range, pivot_index):
@@ -62,70 +62,129 @@ def parse_range(context_range, pivot_index):
     return parsed_range
 
 
-def get_context(cell_id, context_range="all"):
-    content = get_latest_notebook_content(cell_id)
-    cells = content["cells"]
-    current_cell_index = content["current_cell_index"]
-    if context_range != "all":
-        cells = [cells[idx-1] for idx in parse_range(context_range, current_cell_index)]
+def get_context(cell_id, context_range="all", query=None):
+    cells = notebook_context.sync(cell_id)
+    if not cells:
+        return ""
+    indexes, priorities = select_cells(cells, cell_id, context_range, query)
+    if notebook_context.sync_cells(indexes):
+        cells = notebook_context.cells
+        indexes, priorities = select_cells(cells, cell_id, context_range, query)
 
-    context = "\n\n".join(cells)
+    packer = PromptPacker(context_config.get("max_context_tokens", 6000))
+    for idx in indexes:
+        packer.add(format_cell_content(cells[idx], idx), priority=priorities[idx], truncate="head_tail", min_tokens=50)
+    context = "\n\n".join(cell_content for cell_content in packer.pack() if cell_content)
     return context
 
 
+def select_cells(cells, cell_id, context_range, query):
+    current_cell_index = notebook_context.get_cell_index(cell_id)
+    if context_range.startswith("auto"):
+        k = context_config.get("auto_cells", 5)
+        m = re.fullmatch(r"auto(?::(\d+))?", context_range)
+        if m is None:
+            logger.warning(f"invalid context range {context_range}, expected auto or auto:<k>, using auto:{k}")
+        elif m.group(1):
+            k = int(m.group(1))
+        ranked = notebook_context.search_cells(query, k, exclude_cell_id=cell_id)
+        priorities = {idx: -rank for rank, idx in enumerate(ranked)}
+        indexes = sorted(ranked)
+    else:
+        if context_range != "all":
+            requested = parse_range(context_range, current_cell_index)
+            invalid = [idx for idx in requested if not 1 <= idx <= len(cells)]
+            if invalid:
+                logger.warning(f"skip {len(invalid)} cell indexes out of range 1-{len(cells)}: {invalid[:10]}")
+            indexes = [idx-1 for idx in requested if 1 <= idx <= len(cells)]
+        else:
+            indexes = range(len(cells))
+        pivot = (current_cell_index or len(cells)) - 1
+        priorities = {idx: -abs(idx - pivot) for idx in indexes}
+    return indexes, priorities
+
+
+formatted_cells = OrderedDict()
+
+
 def format_cell_content(cell, cell_idx):
+    key = hashlib.sha1(json.dumps(
+        [cell_idx, cell.cell_type, cell.source, cell.get("outputs", [])], sort_keys=True, default=str
+    ).encode("utf-8")).hexdigest()
+    if key in formatted_cells:
+        formatted_cells.move_to_end(key)
+        return formatted_cells[key]
+
+    max_output_chars = context_config.get("max_output_chars", 2000)
     cell_content = f"<cell>\nindex:{cell_idx+1}\ncell_type:{cell.cell_type}\ncontent:{cell.source}\n"
     if cell.cell_type == "code" and cell.outputs:
         cell_content += "outputs:\n"
         for output in cell.outputs:
-            if output.output_type == "stream":
-                cell_content += output.text
-            elif output.output_type == "error":
-                cell_content += output.ename + ":" + output.evalue
+            cell_content += format_output(output, max_output_chars)
+    cell_content = truncate_text(cell_content, context_config.get("max_cell_tokens", 1500), keep="head_tail")
     cell_content += "<cell>"
 
+    formatted_cells[key] = cell_content
+    if len(formatted_cells) > 2048:
+        formatted_cells.popitem(last=False)
     return cell_content
 
 
-history = []
-
-
-def remove_redundant_system_msg(selected_history):
-    prev_system_msg_idx = None
-    for i in range(len(selected_history) - 1, -1, -1):
-        if selected_history[i]["role"] == "system":
-            if not prev_system_msg_idx:
-                prev_system_msg_idx = i
-            elif selected_history[prev_system_msg_idx]["content"] == selected_history[i]["content"]:
-                selected_history.pop(prev_system_msg_idx)
-            else:
-                prev_system_msg_idx = i
+def format_output(output, max_chars):
+    if output.output_type == "stream":
+        return truncate_middle(output.text, max_chars)
+    elif output.output_type == "error":
+        return output.ename + ":" + output.evalue
+    elif output.output_type in ("execute_result", "display_data"):
+        data = output.get("data", {})
+        if "text/html" in data and "<table" in data["text/html"]:
+            rows = data["text/html"].count("<tr") - 1
+            text = truncate_middle(data.get("text/plain", ""), max_chars)
+            return f"[table with {rows} rows]\n{text}\n"
+        if "text/plain" in data and not any(mime.startswith("image/") for mime in data):
+            return truncate_middle(data["text/plain"], max_chars) + "\n"
+        summaries = []
+        for mime in data:
+            if mime.startswith("image/"):
+                summaries.append(f"[{mime} output]")
+            elif mime == "application/vnd.jupyter.widget-view+json":
+                summaries.append("[widget output]")
+        if "text/plain" in data:
+            summaries.append(truncate_middle(data["text/plain"], max_chars))
+        return "\n".join(summaries) + "\n" if summaries else ""
+    return ""
+
+
+def truncate_middle(text, max_chars):
+    if len(text) <= max_chars:
+        return text
+    head = max_chars // 2
+    tail = max_chars - head
+    return f"{text[:head]}\n... {len(text) - max_chars} characters omitted ...\n{text[-tail:]}"
+
+
+history_config = load_config().get("history", {})
+history = HistoryStore(
+    max_turns=history_config.get("max_turns", 50),
+    summarize=history_config.get("summarize", False)
+)
 
 
 def call_nbpilot(query, cell_id, provider="ollama", model=None, history_turns=0, 
                  context_cells=None, debug=False):
-    selected_history = []
-    n = 0
-    if history_turns > 0:
-        for i in range(len(history) - 1, -1, -1):
-            if history[i]["role"] != "system" or context_cells is not None:
-                selected_history.insert(0, history[i])
-                if history[i]["role"] == "user":
-                    n += 1
-                    if n == history_turns:
-                        break
-
-    system_msg = None
+    context_content = None
     if context_cells:
-        context = get_context(cell_id, context_cells)
+        context = get_context(cell_id, context_cells, query)
         if context:
             context_content = "The content of selected cells provided:\n" + context
-            system_msg = {"role": "system", "content": context_content}
-            selected_history.append(system_msg)
 
-    remove_redundant_system_msg(selected_history)
+    selected_history = history.get_messages(
+        history_turns, include_context=context_cells is not None, context=context_content
+    )
     selected_history.insert(0, {"role": "system", "content": system_prompt})
-    response = get_response(query, history=selected_history, provider=provider, model=model, stream=True, debug=debug)
+    max_tokens, model_name = get_prompt_budget(provider, model)
+    messages = pack_messages(selected_history + [{"role": "user", "content": query}], max_tokens, model_name)
+    response = get_response(history=messages, provider=provider, model=model, stream=True, debug=debug)
     assistant_content = ""
     for chunk in response:
         if not chunk.choices:
@@ -135,23 +194,61 @@ def call_nbpilot(query, cell_id, provider="ollama", model=None, history_turns=0,
             print(chunk_content, end="")
             assistant_content += chunk_content
 
-    history.append({"role": "user", "content": query})
-    if system_msg:
-        history.append(system_msg)
-    history.append({"role": "assistant", "content": assistant_content})
+    history.add_turn(query, assistant_content, context_content, provider=provider, model=model)
 
 
-def summarize_webpage(url, lang="Chinese", words=200, provider="ollama", model=None, debug=False):
+def summarize_webpage(url, lang="Chinese", words=200, provider="ollama", model=None, debug=False,
+                      map_reduce=None, max_concurrency=None):
     content = fetch_webpage_content(url)
-    if not content:
+    if not content or not content["content"]:
         print("fail to fetch web page content")
         return
     content = content["content"]
     prompt = (f"Write a concise summary of the following content using {lang}."
-    f"Write with no more than {words} words. \nContent:{content}")
+    f"Write with no more than {words} words. \nContent:")
+    max_tokens, model_name = get_prompt_budget(provider, model)
+    content_budget = max_tokens - count_tokens(prompt, model_name)
+    if map_reduce is None:
+        map_reduce = count_tokens(content, model_name) > content_budget
+    if map_reduce:
+        summarize_config = load_config().get("summarize", {})
+        chunk_tokens = min(summarize_config.get("chunk_tokens", 3000), content_budget)
+        max_concurrency = max_concurrency or summarize_config.get("max_concurrency", 4)
+        summaries = map_summaries(split_text(content, chunk_tokens, model_name), lang,
+                                  provider, model, debug, max_concurrency)
+        while len(summaries) > 1 and count_tokens("\n\n".join(summaries), model_name) > content_budget:
+            logger.info(f"collapsing {len(summaries)} summaries ...")
+            collapsed = map_summaries(split_text("\n\n".join(summaries), chunk_tokens, model_name), lang,
+                                      provider, model, debug, max_concurrency)
+            if len(collapsed) >= len(summaries):
+                break
+            summaries = collapsed
+        prompt = (f"The following are summaries of consecutive parts of a document. Combine them into a concise "
+        f"summary using {lang}. Write with no more than {words} words. \nSummaries:")
+        content = "\n\n".join(summaries)
+    prompt += truncate_text(content, content_budget, model_name)
 
     for chunk in get_response(prompt, provider=provider, model=model, stream=True, debug=debug):
         if not chunk.choices:
             continue
         chunk_content = chunk.choices[0].delta.content
         print(chunk_content or "", end="")
+
+
+def map_summaries(chunks, lang, provider, model, debug=False, max_concurrency=4):
+    prompt = (f"Write a concise summary of the following part of a document using {lang}. "
+    "Keep key facts, names and numbers. \nContent:")
+    summaries = [None] * len(chunks)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {
+            executor.submit(get_response, prompt + chunk, provider=provider, model=model, debug=debug): i
+            for i, chunk in enumerate(chunks)
+        }
+        for n, future in enumerate(as_completed(futures)):
+            i = futures[future]
+            try:
+                summaries[i] = future.result()
+            except Exception as e:
+                logger.warning(f"fail to summarize chunk {i+1}: {e}")
+            logger.info(f"{n+1}/{len(chunks)} chunks summarized")
+    return [summary for summary in summaries if summary]
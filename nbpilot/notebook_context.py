@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import re
+import threading
+import time
+
+import ipynbname
+from loguru import logger
+import nbformat
+
+from .embeddings import cosine_similarity, get_embedding
+
+
+MAGIC_PATTERN = re.compile(r"^\s*%%?nbpilot\b")
+
+
+class CellIndex:
+    def __init__(self):
+        self.vectors = {}
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def _hash(self, source):
+        return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+    def prefetch(self, source):
+        if not source.strip():
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="nbpilot-cell-index")
+        self.executor.submit(self._embed, [source])
+
+    def _embed(self, sources):
+        try:
+            vectors = get_embedding().embed_documents(sources)
+        except Exception as e:
+            logger.warning(f"fail to embed cells: {e}")
+            return
+        with self.lock:
+            for source, vector in zip(sources, vectors):
+                self.vectors[self._hash(source)] = vector
+
+    def search(self, query, cells, k=5, exclude=None):
+        sources = {}
+        for i, cell in enumerate(cells):
+            if i != exclude and cell.source.strip():
+                sources[i] = cell.source
+        missing = [source for source in set(sources.values()) if self._hash(source) not in self.vectors]
+        if missing:
+            self._embed(missing)
+        query_vector = get_embedding().embed_query(query)
+        scores = {}
+        with self.lock:
+            for i, source in sources.items():
+                vector = self.vectors.get(self._hash(source))
+                if vector is not None:
+                    scores[i] = cosine_similarity(query_vector, vector)
+        return sorted(scores, key=scores.get, reverse=True)[:k]
+
+
+class NotebookContext:
+    def __init__(self, app, save_timeout=1.0, poll_interval=0.05, index_cells_on_run=False):
+        self.app = app
+        self.index_cells_on_run = index_cells_on_run
+        self.cell_index = CellIndex()
+        self.save_timeout = save_timeout
+        self.poll_interval = poll_interval
+        self.path = None
+        self.stat = None
+        self.cells = []
+        self.cell_indexes = {}
+        self.kernel_sources = {}
+        self.dirty = set()
+        self.changed = True
+        self.lock = threading.RLock()
+
+    def on_pre_run_cell(self, info):
+        cell_id = getattr(info, "cell_id", None)
+        if cell_id:
+            self.kernel_sources[cell_id] = info.raw_cell
+
+    def on_post_run_cell(self, result):
+        if MAGIC_PATTERN.match(result.info.raw_cell):
+            return
+        cell_id = getattr(result.info, "cell_id", None)
+        with self.lock:
+            if cell_id in self.cell_indexes:
+                self.cells[self.cell_indexes[cell_id]].source = result.info.raw_cell
+                self.dirty.add(cell_id)
+            else:
+                self.changed = True
+        if self.index_cells_on_run:
+            self.cell_index.prefetch(result.info.raw_cell)
+
+    def _get_path(self):
+        if self.path is None:
+            self.path = ipynbname.path()
+        return self.path
+
+    def _get_stat(self):
+        try:
+            stat = os.stat(self._get_path())
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _save(self):
+        stat = self._get_stat()
+        self.app.commands.execute("docmanager:save")
+        deadline = time.time() + self.save_timeout
+        while time.time() < deadline:
+            if self._get_stat() != stat:
+                return True
+            time.sleep(self.poll_interval)
+        logger.warning("timeout waiting for the notebook to be saved")
+        return False
+
+    def _reload(self):
+        stat = self._get_stat()
+        if stat is None or stat == self.stat:
+            return
+        with open(self._get_path(), encoding="utf-8") as fi:
+            notebook = nbformat.read(fi, as_version=4)
+        self.cells = notebook.cells
+        self.cell_indexes = {cell.get("id"): i for i, cell in enumerate(self.cells)}
+        self.stat = stat
+
+    def _is_stale(self, cell_id):
+        return self.changed or cell_id not in self.cell_indexes
+
+    def _refresh(self):
+        self._save()
+        self._reload()
+        self.dirty.clear()
+        self.changed = False
+
+    def sync(self, cell_id=None):
+        with self.lock:
+            self._reload()
+            if self._is_stale(cell_id):
+                self._refresh()
+            source = self.kernel_sources.get(cell_id)
+            if source is not None and cell_id in self.cell_indexes:
+                self.cells[self.cell_indexes[cell_id]].source = source
+            return self.cells
+
+    def sync_cells(self, indexes):
+        with self.lock:
+            if not any(self.cell_indexes.get(cell_id) in indexes for cell_id in self.dirty):
+                return False
+            self._refresh()
+            return True
+
+    def get_cell_index(self, cell_id):
+        index = self.cell_indexes.get(cell_id)
+        return index + 1 if index is not None else None
+
+    def search_cells(self, query, k=5, exclude_cell_id=None):
+        with self.lock:
+            cells = list(self.cells)
+        exclude = self.cell_indexes.get(exclude_cell_id)
+        return self.cell_index.search(query, cells, k, exclude)
@@ -0,0 +1,174 @@
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import math
+import re
+import threading
+
+from loguru import logger
+
+from .config import load_config
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+CJK_PATTERN = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]")
+TRUNCATION_MARK = "\n...\n"
+
+
+@lru_cache(maxsize=32)
+def get_tokenizer(model=None):
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model.split("/")[-1]) if model else tiktoken.get_encoding("cl100k_base")
+        except (KeyError, ValueError):
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"fail to load tokenizer for {model}, estimating tokens instead: {e}")
+        return None
+
+
+def estimate_tokens(text):
+    cjk_chars = len(CJK_PATTERN.findall(text))
+    return cjk_chars + math.ceil((len(text) - cjk_chars) / 4)
+
+
+token_counts = OrderedDict()
+token_counts_lock = threading.Lock()
+
+
+def count_tokens(text, model=None):
+    if not text:
+        return 0
+    key = (hashlib.sha1(text.encode("utf-8", "surrogatepass")).digest(), model)
+    with token_counts_lock:
+        if key in token_counts:
+            token_counts.move_to_end(key)
+            return token_counts[key]
+    tokenizer = get_tokenizer(model)
+    if tokenizer is None:
+        count = estimate_tokens(text)
+    else:
+        count = len(tokenizer.encode(text, disallowed_special=()))
+    with token_counts_lock:
+        token_counts[key] = count
+        if len(token_counts) > 4096:
+            token_counts.popitem(last=False)
+    return count
+
+
+def truncate_text(text, max_tokens, model=None, keep="head"):
+    if max_tokens <= 0:
+        return ""
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    if keep == "head_tail":
+        head = truncate_text(text, max_tokens // 2, model, "head")
+        tail = truncate_text(text, max_tokens - max_tokens // 2, model, "tail")
+        return head + TRUNCATION_MARK + tail
+    tokenizer = get_tokenizer(model)
+    if tokenizer is not None:
+        tokens = tokenizer.encode(text, disallowed_special=())
+        tokens = tokens[:max_tokens] if keep == "head" else tokens[-max_tokens:]
+        return tokenizer.decode(tokens)
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        part = text[:middle] if keep == "head" else text[-middle:]
+        if estimate_tokens(part) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] if keep == "head" else text[len(text)-low:]
+
+
+def split_text(text, max_tokens, model=None):
+    chunks = []
+    current = []
+    current_tokens = 0
+    for paragraph in text.split("\n\n"):
+        tokens = count_tokens(paragraph, model)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n\n".join(current))
+            current = []
+            current_tokens = 0
+        if tokens > max_tokens:
+            piece_len = max(int(len(paragraph) * max_tokens / tokens * 0.9), 1)
+            chunks.extend(paragraph[i:i+piece_len] for i in range(0, len(paragraph), piece_len))
+            continue
+        current.append(paragraph)
+        current_tokens += tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def get_prompt_budget(provider, model=None):
+    config = load_config()
+    prompt_config = config.get("prompt", {})
+    llm_config = config["llm"].get(provider, {})
+    context_window = llm_config.get("context_window", prompt_config.get("context_window", 8192))
+    completion_tokens = llm_config.get("completion_tokens", prompt_config.get("completion_tokens", 1500))
+    return context_window - completion_tokens, model or llm_config.get("model_name")
+
+
+class PromptPacker:
+    def __init__(self, max_tokens, model=None):
+        self.max_tokens = max_tokens
+        self.model = model
+        self.sections = []
+
+    def add(self, content, priority=0, truncate=None, min_tokens=0):
+        self.sections.append({
+            "content": content or "", "priority": priority, "truncate": truncate, "min_tokens": min_tokens
+        })
+        return len(self.sections) - 1
+
+    def pack(self):
+        packed = [None] * len(self.sections)
+        remaining = self.max_tokens
+        order = sorted(range(len(self.sections)), key=lambda i: self.sections[i]["priority"], reverse=True)
+        for i in order:
+            section = self.sections[i]
+            tokens = count_tokens(section["content"], self.model)
+            if tokens <= remaining:
+                packed[i] = section["content"]
+                remaining -= tokens
+            elif section["truncate"] and remaining > max(section["min_tokens"], 0):
+                packed[i] = truncate_text(section["content"], remaining, self.model, section["truncate"])
+                remaining -= count_tokens(packed[i], self.model)
+        return packed
+
+
+def pack_messages(messages, max_tokens, model=None):
+    packer = PromptPacker(max_tokens, model)
+    n = len(messages)
+    for i, message in enumerate(messages):
+        if i == n - 1 or (i == 0 and message["role"] == "system"):
+            packer.add(message["content"], priority=2 * n, truncate="head_tail")
+        elif message["role"] == "system":
+            packer.add(message["content"], priority=n + i, truncate="head_tail", min_tokens=200)
+        else:
+            packer.add(message["content"], priority=i, truncate="head_tail", min_tokens=200)
+    packed = []
+    for message, content in zip(messages, packer.pack()):
+        if content is not None:
+            packed.append(dict(message, content=content))
+    return packed
+
+
+def pack_references(references, max_tokens, model=None):
+    packed = []
+    total_tokens = 0
+    for reference in references:
+        tokens = count_tokens(reference["content"], model)
+        if total_tokens + tokens > max_tokens:
+            continue
+        packed.append(reference)
+        total_tokens += tokens
+    return packed
@@ -1,17 +1,21 @@
+import hashlib
 import re
-import time
 
-from IPython.display import clear_output, display, Markdown
 from langchain_core.documents.base import Document
-from langchain.embeddings.sentence_transformer import SentenceTransformerEmbeddings
 from langchain.text_splitter import MarkdownTextSplitter
-from langchain.vectorstores.chroma import Chroma
 from loguru import logger
-import torch
 
 from .config import load_config
+from .embeddings import cosine_similarity, get_embedding, get_reranker
+from .index_store import (
+    has_index, load_index_meta, load_keyword_index, open_index, save_index_meta, save_keyword_index
+)
+from .keyword_index import BM25Index
 from .llm import get_response
-from .tools import get_search_results, fetch_webpage_content
+from .prompt import count_tokens, get_prompt_budget, pack_references, truncate_text
+from .streaming import MarkdownStream, StreamingOutputParser
+from .tracing import set_attributes, span, traced
+from .tools import crawl_webpages, fetch_webpages, get_search_results, get_sitemap_urls
 
 
 def format_references(references):
@@ -52,55 +56,9 @@ question3
 
 
 def parse_output(output):
-    APPLICABLE_REFERENCE = "applicable references"
-    ANSWER = "answer"
-    FOLLOW_UP_QUESTIONS = "follow-up questions"
-    CITATION_PATTERN = re.compile("\[citation:(\d+)\]")
-    QUESTION_MARK = re.compile("[?？]")
-    result = {"raw": output}
-    lines = output.strip().split("\n")
-    line = lines[0].lower()
-    if line.startswith(APPLICABLE_REFERENCE):
-        line = line[line.find(APPLICABLE_REFERENCE)+1:]
-        if CITATION_PATTERN.search(line) is None:
-            return result
-    else:
-        return result
-
-    idx = 1
-    start = None
-    end = None
-    while idx < len(lines):
-        line = lines[idx].strip().lower()
-        if start is None and line.lower().startswith(ANSWER):
-            start = idx
-        if start is not None and end is None and line.startswith(FOLLOW_UP_QUESTIONS):
-            end = idx
-            break
-        idx += 1
-    answer = None
-    if start is not None:
-        if end is None:
-            end = len(lines)
-        answer = "\n".join(lines[start:end]).strip()
-        answer = answer[len(ANSWER)+1:].strip()
-        result["answer"] = answer
-    else:
-        return result
-
-    questions = []
-    if end is not None:
-        text = "\n".join(lines[end:]).strip()
-        text = text[len(FOLLOW_UP_QUESTIONS)+1:].strip()
-        splits = text.split("\n")
-        if len(splits) == 3:
-            questions = [split.strip() for split in splits]
-        else:
-            splits = QUESTION_MARK.split(text)
-            questions = [split.strip() for split in splits]
-        result["followup-questions"] = questions
-
-    return result
+    parser = StreamingOutputParser()
+    parser.feed(output)
+    return parser.result()
 
 
 def format_result(result):
@@ -128,117 +86,326 @@ def format_result(result):
     return md_content
 
 
+def fetch_reference_chunks(references, top_pages, chunk_size=500):
+    titles = {reference["url"]: reference["title"] for reference in references}
+    urls = list(titles)[:top_pages]
+    spliter = MarkdownTextSplitter(chunk_size=chunk_size, chunk_overlap=50)
+    chunks = []
+    for url, content in fetch_webpages(urls, max_workers=max(len(urls), 1)):
+        if content is None or not content["content"]:
+            logger.warning(f"fail to fetch web page content of {url}")
+            continue
+        for text in spliter.split_text(content["content"]):
+            chunks.append({"title": titles[url], "url": url, "content": text})
+    logger.info(f"{len(chunks)} chunks fetched from {len(urls)} pages")
+    return chunks
+
+
+def rank_references(question, references):
+    embedding = get_embedding()
+    vectors = embedding.embed_documents([reference["content"] for reference in references])
+    query_vector = embedding.embed_query(question)
+    scores = [cosine_similarity(query_vector, vector) for vector in vectors]
+    ranked = sorted(zip(references, scores), key=lambda item: item[1], reverse=True)
+    return [reference for reference, _ in ranked]
+
+
+def compress_references(question, references, enrich_pages=0, max_tokens=3000, chunk_size=500, model=None):
+    if enrich_pages > 0:
+        references = references + fetch_reference_chunks(references, enrich_pages, chunk_size)
+    references = [reference for reference in references if reference.get("content")]
+    return pack_references(rank_references(question, references), max_tokens, model)
+
+
 def search_and_answer(history_questions, question, compress_context=False,
-                      provider=None, model=None, debug=False):
+                      provider=None, model=None, debug=False, engine="ms", enrich_pages=None):
     logger.info("searching web ...")
-    references = get_search_results(question)
+    references = get_search_results(question, engine)
     if len(references) == 0:
         logger.warning("no references fetched.")
         return
     else:
         logger.info(f"{len(references)} references fetched")
-    if compress_context:
+    search_config = load_config().get("rag", {}).get("search", {})
+    if enrich_pages is None:
+        enrich_pages = search_config.get("enrich_pages", 0)
+    if compress_context or enrich_pages > 0:
         logger.info("compressing references ...")
+        references = compress_references(
+            question, references, enrich_pages,
+            max_tokens=search_config.get("max_context_tokens", 3000),
+            chunk_size=search_config.get("chunk_size", 500),
+            model=get_prompt_budget(provider, model)[1]
+        )
     if len(references) == 0:
         logger.warning("no useful references found")
         return
     else:
         logger.info(f"{len(references)} useful references found")
-    refs_text = format_references(references)
     history_questions = ";".join(history_questions)
     prompt = answer_prompt.replace("{{history_questions}}", history_questions)
     prompt = prompt.replace("{{question}}", question)
+    max_tokens, model_name = get_prompt_budget(provider, model)
+    references = pack_references(references, max_tokens - count_tokens(prompt, model_name), model_name)
+    refs_text = format_references(references)
     prompt = prompt.replace("{{referenes}}", refs_text)
     logger.info("extracting answer...")
     response = get_response(prompt, provider=provider, model=model, stream=True, debug=debug)
-    content = ""
-    cache_content = ""
-    start = time.time()
+    parser = StreamingOutputParser()
+    view = MarkdownStream()
     for chunk in response:
         if not chunk.choices:
             continue
         chunk_content = chunk.choices[0].delta.content
         if chunk_content is not None:
-            cache_content += chunk_content
-            end = time.time()
-            if int((end - start) * 1000) > 200:
-                content += cache_content
-                result = parse_output(content)
-                cache_content = ""
+            parser.feed(chunk_content)
+            if view.due():
+                result = parser.result()
                 if "answer" in result:
-                    md = format_result(result)
-                    clear_output()
-                    display(Markdown(md))
-                start = time.time()
-    if cache_content:
-        content += cache_content
-        result = parse_output(content)
+                    view.update(format_result(result))
+    result = parser.result()
+    result.setdefault("answer", result["raw"])
     result["references"] = references
-    md = format_result(result)
-    clear_output()
-    display(Markdown(md))
+    view.update(format_result(result))
 
 
 INDEXES = {}
+KEYWORD_INDEXES = {}
 DEFAULT_INDEX = "DEFAULT_INDEX"
-embedding = None
+DEFAULT_RETRIEVAL = {
+    "k": 5,
+    "score_threshold": 0.3,
+    "vector_weight": 1.0,
+    "keyword_weight": 1.0,
+    "rrf_k": 60,
+    "rerank": False,
+    "rerank_model": None
+}
+
+
+def load_index(index_name):
+    if index_name in INDEXES:
+        return INDEXES[index_name]
+    if not has_index(index_name):
+        return None
+    vector_store = open_index(index_name, get_embedding())
+    INDEXES[index_name] = vector_store
+    logger.info(f"index {index_name} loaded from disk")
+    return vector_store
 
 
-def build_index_from_url(url, index_name=None):
-    content = fetch_webpage_content(url)
-    if content is None:
-        logger.error("fail to fetch web page content")
+def get_keyword_index(index_name):
+    if index_name in KEYWORD_INDEXES:
+        return KEYWORD_INDEXES[index_name]
+    keyword_index = load_keyword_index(index_name)
+    if keyword_index is None:
+        keyword_index = BM25Index()
+        vector_store = load_index(index_name)
+        if vector_store is not None:
+            existing = vector_store.get(include=["documents"])
+            for chunk_id, text in zip(existing["ids"], existing["documents"]):
+                keyword_index.add(chunk_id, text)
+    KEYWORD_INDEXES[index_name] = keyword_index
+    return keyword_index
+
+
+def build_index_from_url(url, index_name=None, refresh=False):
+    build_index_from_urls([url], index_name, refresh=refresh)
+
+
+@traced("index.build")
+def build_index_from_urls(urls, index_name=None, sitemap=None, depth=0, refresh=False,
+                          max_workers=8, batch_size=256):
+    if index_name is None:
+        index_name = DEFAULT_INDEX
+    sources = list(urls or []) + ([sitemap] if sitemap else [])
+    if not sources:
+        logger.error("no url or sitemap given")
+        return
+    if not refresh and all(has_index(index_name, source) for source in sources):
+        load_index(index_name)
+        logger.info(f"index {index_name} of {', '.join(sources)} already exists, use --refresh to rebuild it")
         return
-    doc = Document(
-        page_content=content["content"], 
-        metadata={"title": content["title"], "source": content["source"]}
-    )
+    urls = list(urls or [])
+    if sitemap:
+        urls.extend(get_sitemap_urls(sitemap))
+        logger.info(f"{len(urls)} urls to read")
+    vector_store = load_index(index_name)
+    if vector_store is None:
+        vector_store = open_index(index_name, get_embedding())
+        INDEXES[index_name] = vector_store
+    keyword_index = get_keyword_index(index_name)
+    writer = IndexWriter(vector_store, keyword_index, batch_size)
     spliter = MarkdownTextSplitter(chunk_size=300, chunk_overlap=50)
-    docs = spliter.split_documents([doc])
-    global embedding
-    if embedding is None:
-        config = load_config()
-        model_path = config["rag"]["embedding"]["model_path"]
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        model_kwargs = {'device': device}
-        embedding = SentenceTransformerEmbeddings(model_name=model_path, model_kwargs=model_kwargs)
+    failed_urls = []
+    for url, content in crawl_webpages(urls, depth, max_workers, revalidate=refresh):
+        if content is None or not content["content"]:
+            logger.warning(f"fail to fetch web page content of {url}")
+            failed_urls.append(url)
+            continue
+        doc = Document(
+            page_content=content["content"], 
+            metadata={"title": content["title"], "source": content["source"], "url": url}
+        )
+        writer.add(spliter.split_documents([doc]))
+    if not writer.seen_ids:
+        logger.error("fail to fetch web page content")
+        return
+    writer.finish(keep_urls=failed_urls)
+    set_attributes(index=index_name, pages=len(urls), failed_pages=len(failed_urls), chunks=len(writer.seen_ids))
+    save_keyword_index(index_name, keyword_index)
+    save_index_meta(index_name, {"sources": sources})
+    logger.info("building index done")
+
+
+def hash_chunk(doc):
+    text = doc.metadata.get("url", "") + "\n" + doc.page_content
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class IndexWriter:
+    def __init__(self, vector_store, keyword_index, batch_size=256):
+        self.vector_store = vector_store
+        self.keyword_index = keyword_index
+        self.batch_size = batch_size
+        existing = vector_store.get(include=["metadatas"])
+        self.existing_ids = {
+            chunk_id: (metadata or {}).get("url")
+            for chunk_id, metadata in zip(existing["ids"], existing["metadatas"])
+        }
+        self.seen_ids = set()
+        self.pending = []
+        self.added = 0
+
+    def add(self, docs):
+        for doc in docs:
+            chunk_id = hash_chunk(doc)
+            if chunk_id in self.seen_ids:
+                continue
+            self.seen_ids.add(chunk_id)
+            if chunk_id not in self.existing_ids:
+                doc.metadata["chunk_hash"] = chunk_id
+                self.pending.append(doc)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        ids = [doc.metadata["chunk_hash"] for doc in self.pending]
+        self.vector_store.add_documents(self.pending, ids=ids)
+        for chunk_id, doc in zip(ids, self.pending):
+            self.keyword_index.add(chunk_id, doc.page_content)
+        self.added += len(self.pending)
+        logger.info(f"{self.added} chunks embedded")
+        self.pending = []
+
+    def finish(self, keep_urls=None):
+        self.flush()
+        keep_urls = set(keep_urls or [])
+        stale_ids = [
+            chunk_id for chunk_id, url in self.existing_ids.items()
+            if chunk_id not in self.seen_ids and url not in keep_urls
+        ]
+        if stale_ids:
+            self.vector_store.delete(ids=stale_ids)
+        for chunk_id in stale_ids:
+            self.keyword_index.remove(chunk_id)
+        self.vector_store.persist()
+        logger.info(f"{self.added} chunks embedded, {len(stale_ids)} stale chunks deleted, "
+                    f"{len(self.seen_ids) - self.added} chunks unchanged")
+
+
+def get_retrieval_settings(index_name, **overrides):
+    config = load_config()
+    settings = dict(DEFAULT_RETRIEVAL, **config.get("rag", {}).get("retrieval", {}))
+    settings.update((load_index_meta(index_name) or {}).get("retrieval", {}))
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+    return settings
+
+
+def configure_retrieval(index_name=None, **settings):
     if index_name is None:
         index_name = DEFAULT_INDEX
-    if index_name in INDEXES:
-        INDEXES[index_name].delete_collection()
-    vector_store = Chroma.from_documents(
-        docs,
-        embedding,
-        collection_name=index_name,
-        collection_metadata={"hnsw:space": "cosine"}
-    )
-    INDEXES[index_name] = vector_store
-    logger.info("building index done")
+    settings = {key: value for key, value in settings.items() if value is not None}
+    if not settings:
+        return
+    if not has_index(index_name):
+        logger.error(f"index {index_name} does not exist")
+        return
+    meta = load_index_meta(index_name)
+    save_index_meta(index_name, {"retrieval": dict(meta.get("retrieval", {}), **settings)})
 
 
-def get_references_from_index(query, index_name=None):
+@traced("retrieval")
+def search_index(query, index_name=None, **overrides):
     if index_name is None:
         index_name = DEFAULT_INDEX
-    if index_name not in INDEXES:
+    vector_store = load_index(index_name)
+    if vector_store is None:
         logger.error(f"index {index_name} does not exist")
-        return ""
-    vector_store = INDEXES[index_name]
-    retriver = vector_store.as_retriever(search_type="similarity_score_threshold", search_kwargs={"score_threshold": 0.3, "k": 5})
+        return []
+    settings = get_retrieval_settings(index_name, **overrides)
+    set_attributes(index=index_name, k=settings["k"], rerank=settings["rerank"])
+    n_candidates = max(settings["k"] * 4, 20)
+    candidates = {}
+    scores = {}
+    if settings["vector_weight"] > 0:
+        with span("retrieval.vector", index=index_name):
+            hits = vector_store.similarity_search_with_relevance_scores(query, k=n_candidates)
+        hits = [(doc, score) for doc, score in hits if score >= settings["score_threshold"]]
+        for rank, (doc, _) in enumerate(hits):
+            chunk_id = doc.metadata.get("chunk_hash") or hash_chunk(doc)
+            candidates[chunk_id] = doc
+            scores[chunk_id] = scores.get(chunk_id, 0) + settings["vector_weight"] / (settings["rrf_k"] + rank + 1)
+    if settings["keyword_weight"] > 0:
+        with span("retrieval.keyword", index=index_name):
+            hits = get_keyword_index(index_name).search(query, n_candidates)
+        for rank, (chunk_id, _) in enumerate(hits):
+            scores[chunk_id] = scores.get(chunk_id, 0) + settings["keyword_weight"] / (settings["rrf_k"] + rank + 1)
+        missing_ids = [chunk_id for chunk_id, _ in hits if chunk_id not in candidates]
+        if missing_ids:
+            result = vector_store.get(ids=missing_ids, include=["documents", "metadatas"])
+            for chunk_id, text, metadata in zip(result["ids"], result["documents"], result["metadatas"]):
+                candidates[chunk_id] = Document(page_content=text, metadata=metadata or {})
+    ranked_ids = sorted((chunk_id for chunk_id in scores if chunk_id in candidates), key=scores.get, reverse=True)
+    docs = [candidates[chunk_id] for chunk_id in ranked_ids]
+    if settings["rerank"] and docs:
+        if settings["rerank_model"]:
+            docs = rerank(query, docs, settings["rerank_model"])
+        else:
+            logger.warning("rerank is enabled but no rerank_model is configured")
+    set_attributes(results=min(len(docs), settings["k"]))
+    return docs[:settings["k"]]
+
+
+@traced("rerank")
+def rerank(query, docs, model_path):
+    set_attributes(model=model_path, docs=len(docs))
+    reranker = get_reranker(model_path)
+    scores = reranker.predict([(query, doc.page_content) for doc in docs])
+    ranked = sorted(zip(docs, scores), key=lambda item: item[1], reverse=True)
+    return [doc for doc, _ in ranked]
+
+
+def get_references_from_index(query, index_name=None, **settings):
     refs_text = ""
-    for i, reference in enumerate(retriver.get_relevant_documents(query)):
+    for i, reference in enumerate(search_index(query, index_name, **settings)):
         content = reference.page_content.replace("\n", "  ").strip()
         refs_text += f"[citation:{i+1}]{content}\n\n"
 
     return refs_text.strip()
 
 
-def retrieve_and_answer(question, index_name=None, provider=None, model=None, debug=False):
-    refs_text = get_references_from_index(question, index_name)
+def retrieve_and_answer(question, index_name=None, provider=None, model=None, debug=False, **settings):
+    refs_text = get_references_from_index(question, index_name, **settings)
     if not refs_text:
         logger.warning("no references fetched.")
     history_questions = ""
     prompt = answer_prompt.replace("{{history_questions}}", history_questions)
     prompt = prompt.replace("{{question}}", question)
+    max_tokens, model_name = get_prompt_budget(provider, model)
+    refs_text = truncate_text(refs_text, max_tokens - count_tokens(prompt, model_name), model_name)
     prompt = prompt.replace("{{referenes}}", refs_text)
     logger.info("extracting answer...")
     response = get_response(prompt, provider=provider, model=model, stream=True, debug=debug)
@@ -0,0 +1,299 @@
+import asyncio
+from contextlib import contextmanager
+import json
+import os
+import re
+import threading
+import time
+
+from loguru import logger
+
+from .cache import get_cache_path
+from .config import load_config
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+WAITER_TIMEOUT = 10
+
+
+class RateLimitCancelled(Exception):
+    pass
+
+
+class RateLimiter:
+    def __init__(self, key, rpm=None, tpm=None, max_in_flight=None, poll_interval=0.05):
+        self.key = key
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        name = re.sub(r"[^\w.-]", "_", key)
+        self.state_path = get_cache_path(f"ratelimits/{name}.json")
+        self.state_path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock_path = self.state_path.with_suffix(".lock")
+        self.thread_lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self.thread_lock, open(self.lock_path, "a+") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                state = self._load()
+                yield state
+                self._save(state)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self):
+        try:
+            with open(self.state_path, encoding="utf-8") as fi:
+                return json.load(fi)
+        except (OSError, ValueError):
+            return {"next_ticket": 0, "serving": 0, "waiters": {}, "in_flight": {}, "buckets": {}}
+
+    def _save(self, state):
+        tmp_path = self.state_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as fo:
+            json.dump(state, fo)
+        os.replace(tmp_path, self.state_path)
+
+    def _refill(self, state, now):
+        for name, capacity in (("requests", self.rpm), ("tokens", self.tpm)):
+            if not capacity:
+                continue
+            bucket = state["buckets"].setdefault(name, {"level": capacity, "updated": now})
+            bucket["level"] = min(capacity, bucket["level"] + (now - bucket["updated"]) * capacity / 60)
+            bucket["updated"] = now
+
+    def _cleanup(self, state, now):
+        for pid in list(state["in_flight"]):
+            if not pid_alive(int(pid)):
+                del state["in_flight"][pid]
+        waiters = state["waiters"]
+        while state["serving"] < state["next_ticket"]:
+            waiter = waiters.get(str(state["serving"]))
+            if waiter is not None and now - waiter[1] < WAITER_TIMEOUT and pid_alive(waiter[0]):
+                break
+            waiters.pop(str(state["serving"]), None)
+            state["serving"] += 1
+
+    def _wait_time(self, state, tokens, now):
+        wait_time = 0
+        if self.rpm and state["buckets"]["requests"]["level"] < 1:
+            wait_time = max(wait_time, (1 - state["buckets"]["requests"]["level"]) * 60 / self.rpm)
+        if self.tpm and state["buckets"]["tokens"]["level"] < tokens:
+            wait_time = max(wait_time, (tokens - state["buckets"]["tokens"]["level"]) * 60 / self.tpm)
+        if self.max_in_flight and sum(state["in_flight"].values()) >= self.max_in_flight:
+            wait_time = max(wait_time, self.poll_interval)
+        return wait_time
+
+    def acquire(self, tokens=0, deadline=None, stop=None):
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+        pid = os.getpid()
+        with self._locked() as state:
+            ticket = state["next_ticket"]
+            state["next_ticket"] += 1
+            state["waiters"][str(ticket)] = [pid, time.time()]
+        start = time.time()
+        try:
+            while True:
+                if stop is not None and stop.is_set():
+                    raise RateLimitCancelled(f"waiting for rate limit of {self.key} cancelled")
+                if deadline is not None and time.time() >= deadline:
+                    raise TimeoutError(f"rate limit of {self.key} not acquired before the deadline")
+                with self._locked() as state:
+                    now = time.time()
+                    if state["serving"] > ticket:
+                        ticket = state["next_ticket"]
+                        state["next_ticket"] += 1
+                    state["waiters"][str(ticket)] = [pid, now]
+                    self._refill(state, now)
+                    self._cleanup(state, now)
+                    wait_time = self.poll_interval
+                    if state["serving"] == ticket:
+                        wait_time = self._wait_time(state, tokens, now)
+                        if wait_time == 0:
+                            if self.rpm:
+                                state["buckets"]["requests"]["level"] -= 1
+                            if self.tpm:
+                                state["buckets"]["tokens"]["level"] -= tokens
+                            state["in_flight"][str(pid)] = state["in_flight"].get(str(pid), 0) + 1
+                            del state["waiters"][str(ticket)]
+                            state["serving"] += 1
+                            break
+                if deadline is not None:
+                    wait_time = min(wait_time, max(deadline - time.time(), 0))
+                if stop is not None:
+                    stop.wait(min(wait_time, 1.0))
+                else:
+                    time.sleep(min(wait_time, 1.0))
+        except BaseException:
+            with self._locked() as state:
+                state["waiters"].pop(str(ticket), None)
+            raise
+        waited = time.time() - start
+        if waited > 1:
+            logger.debug(f"waited {waited:.1f}s for rate limit of {self.key}")
+        return Lease(self, tokens)
+
+    def release(self, tokens=0, used_tokens=None):
+        pid = str(os.getpid())
+        with self._locked() as state:
+            if state["in_flight"].get(pid, 0) > 1:
+                state["in_flight"][pid] -= 1
+            else:
+                state["in_flight"].pop(pid, None)
+            if self.tpm and used_tokens is not None:
+                self._refill(state, time.time())
+                bucket = state["buckets"]["tokens"]
+                bucket["level"] = min(self.tpm, bucket["level"] + tokens - used_tokens)
+
+
+class Lease:
+    def __init__(self, limiter, tokens):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.released = False
+
+    def release(self, used_tokens=None):
+        if self.released:
+            return
+        self.released = True
+        self.limiter.release(self.tokens, used_tokens)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.release()
+
+
+def pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(kind, name):
+    limit_config = load_config().get("rate_limits", {}).get(kind, {}).get(name)
+    if not limit_config:
+        return None
+    key = f"{kind}-{name}"
+    with limiters_lock:
+        if key not in limiters:
+            limiters[key] = RateLimiter(
+                key, limit_config.get("rpm"), limit_config.get("tpm"), limit_config.get("max_in_flight")
+            )
+    return limiters[key]
+
+
+def acquire(kind, name, tokens=0, deadline=None, stop=None):
+    limiter = get_rate_limiter(kind, name)
+    return limiter.acquire(tokens, deadline, stop) if limiter is not None else None
+
+
+@contextmanager
+def rate_limited(kind, name, tokens=0, deadline=None, stop=None):
+    lease = acquire(kind, name, tokens, deadline, stop)
+    try:
+        yield lease
+    finally:
+        if lease is not None:
+            lease.release()
+
+
+class LeasedStream:
+    def __init__(self, response, lease, count_tokens=None):
+        self.response = response
+        self.iterator = iter(response)
+        self.lease = lease
+        self.count_tokens = count_tokens
+        self.parts = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self.iterator)
+        except BaseException:
+            self.close()
+            raise
+        if self.count_tokens is not None and chunk.choices and chunk.choices[0].delta.content:
+            self.parts.append(chunk.choices[0].delta.content)
+        return chunk
+
+    def close(self):
+        if self.lease.released:
+            return
+        close = getattr(self.response, "close", None)
+        if close is not None:
+            close()
+        self.lease.release(self.count_tokens("".join(self.parts)) if self.count_tokens is not None else None)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class AsyncLeasedStream:
+    def __init__(self, response, lease, count_tokens=None):
+        self.response = response
+        self.iterator = response.__aiter__()
+        self.lease = lease
+        self.count_tokens = count_tokens
+        self.parts = []
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self.iterator.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+        if self.count_tokens is not None and chunk.choices and chunk.choices[0].delta.content:
+            self.parts.append(chunk.choices[0].delta.content)
+        return chunk
+
+    def release(self):
+        if self.lease.released:
+            return
+        self.lease.release(self.count_tokens("".join(self.parts)) if self.count_tokens is not None else None)
+
+    async def aclose(self):
+        if self.lease.released:
+            return
+        close = getattr(self.response, "aclose", None) or getattr(self.response, "close", None)
+        try:
+            if close is not None:
+                result = close()
+                if asyncio.iscoroutine(result):
+                    await result
+        finally:
+            self.release()
+
+    def __del__(self):
+        try:
+            self.release()
+        except Exception:
+            pass
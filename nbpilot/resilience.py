@@ -0,0 +1,262 @@
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import contextvars
+import random
+import threading
+import time
+
+import httpx
+from loguru import logger
+
+from .config import load_config
+from .jobs import JobCancelled, current_job, raise_if_cancelled
+
+
+DEFAULT_POLICY = {
+    "connect_timeout": 10,
+    "first_token_timeout": 60,
+    "total_timeout": 300,
+    "retries": 2,
+    "backoff": 0.5,
+    "max_backoff": 8,
+    "failover": [],
+    "hedge_after": None
+}
+NON_RETRYABLE_STATUS = {400, 401, 403, 404, 422}
+CANCEL_POLL_INTERVAL = 0.2
+
+executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="nbpilot-llm")
+
+
+def get_policy(provider):
+    config = load_config()
+    policy = dict(DEFAULT_POLICY, **config.get("resilience", {}))
+    policy.update(config["llm"].get(provider, {}).get("resilience", {}))
+    return policy
+
+
+def get_candidates(provider, policy):
+    providers = load_config()["llm"]
+    failover = policy.get("failover") or []
+    if failover == "all":
+        failover = list(providers)
+    return [provider] + [candidate for candidate in failover if candidate != provider and candidate in providers]
+
+
+def get_timeout(policy, stream):
+    read_timeout = policy["first_token_timeout"] if stream else policy["total_timeout"]
+    return httpx.Timeout(policy["total_timeout"], connect=policy["connect_timeout"], read=read_timeout)
+
+
+def get_status_code(error):
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code
+
+
+def is_retryable(error):
+    if isinstance(error, (JobCancelled, KeyError, TypeError)):
+        return False
+    return get_status_code(error) not in NON_RETRYABLE_STATUS
+
+
+def backoff_delay(attempt, policy):
+    return random.uniform(0, min(policy["max_backoff"], policy["backoff"] * 2 ** attempt))
+
+
+def with_retries(func, policy, deadline=None, name="", stop=None):
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= policy["retries"] or not is_retryable(e) or (stop is not None and stop.is_set()):
+                raise
+            delay = backoff_delay(attempt, policy)
+            if deadline is not None and time.time() + delay >= deadline:
+                raise
+            logger.warning(f"{name} request failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+def read_first_chunk(iterator, timeout):
+    result = {}
+    done = threading.Event()
+
+    def read():
+        try:
+            result["chunk"] = next(iterator, None)
+        except BaseException as e:
+            result["error"] = e
+        done.set()
+
+    threading.Thread(target=read, name="nbpilot-first-token", daemon=True).start()
+    if not done.wait(timeout):
+        raise TimeoutError(f"no token received within {timeout}s")
+    if "error" in result:
+        raise result["error"]
+    return result["chunk"]
+
+
+def guard_stream(response, policy, deadline):
+    iterator = iter(response)
+    timeout = policy["first_token_timeout"]
+    if deadline is not None:
+        timeout = min(timeout, max(deadline - time.time(), 0))
+    try:
+        first = read_first_chunk(iterator, timeout)
+    except BaseException:
+        close_response(response)
+        raise
+    return deadline_stream(first, iterator, response, deadline)
+
+
+def deadline_stream(first, iterator, response, deadline):
+    try:
+        if first is None:
+            return
+        yield first
+        for chunk in iterator:
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError("total deadline exceeded, the response is truncated")
+            yield chunk
+    finally:
+        close_response(response)
+
+
+def close_response(response):
+    close = getattr(response, "close", None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            pass
+
+
+def run_candidates(candidates, attempt, hedge_after=None, deadline=None):
+    candidates = list(candidates)
+    futures = {}
+    last_error = None
+    stop = threading.Event()
+    hedge_at = None
+
+    def launch():
+        nonlocal hedge_at
+        candidate = candidates.pop(0)
+        futures[executor.submit(contextvars.copy_context().run, attempt, candidate, stop)] = candidate
+        hedge_at = time.time() + hedge_after if hedge_after is not None else None
+
+    launch()
+    try:
+        while futures:
+            raise_if_cancelled()
+            now = time.time()
+            timeouts = [CANCEL_POLL_INTERVAL] if current_job() is not None else []
+            if candidates and hedge_at is not None:
+                timeouts.append(max(hedge_at - now, 0))
+            if deadline is not None:
+                timeouts.append(max(deadline - now, 0))
+            done, _ = wait(futures, timeout=min(timeouts, default=None), return_when=FIRST_COMPLETED)
+            if not done:
+                if deadline is not None and time.time() >= deadline:
+                    raise TimeoutError(f"no response from {', '.join(futures.values())} before the deadline")
+                if not candidates or hedge_at is None or time.time() < hedge_at:
+                    continue
+                logger.info(f"no response after {hedge_after}s, hedging with {candidates[0]}")
+                launch()
+                continue
+            for future in done:
+                candidate = futures.pop(future)
+                try:
+                    return candidate, future.result()
+                except JobCancelled:
+                    raise
+                except Exception as e:
+                    last_error = e
+                    logger.warning(f"provider {candidate} failed: {type(e).__name__}: {e}")
+                    if candidates and not futures:
+                        logger.info(f"failing over to {candidates[0]}")
+                        launch()
+        raise last_error
+    finally:
+        stop.set()
+        for future in futures:
+            future.add_done_callback(discard_result)
+
+
+def discard_result(future):
+    if not future.cancelled() and future.exception() is None:
+        close_response(future.result())
+
+
+async def awith_retries(func, policy, deadline=None, name=""):
+    attempt = 0
+    while True:
+        try:
+            return await func()
+        except Exception as e:
+            if attempt >= policy["retries"] or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt, policy)
+            if deadline is not None and time.time() + delay >= deadline:
+                raise
+            logger.warning(f"{name} request failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def aguard_stream(response, policy, deadline):
+    iterator = response.__aiter__()
+    timeout = policy["first_token_timeout"]
+    if deadline is not None:
+        timeout = min(timeout, max(deadline - time.time(), 0))
+    try:
+        first = await asyncio.wait_for(iterator.__anext__(), timeout)
+    except StopAsyncIteration:
+        first = None
+    except BaseException:
+        await aclose_response(response)
+        raise
+    return adeadline_stream(first, iterator, response, deadline)
+
+
+async def adeadline_stream(first, iterator, response, deadline):
+    try:
+        if first is None:
+            return
+        yield first
+        async for chunk in iterator:
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError("total deadline exceeded, the response is truncated")
+            yield chunk
+    finally:
+        await aclose_response(response)
+
+
+async def aclose_response(response):
+    close = getattr(response, "aclose", None) or getattr(response, "close", None)
+    if close is not None:
+        try:
+            result = close()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception:
+            pass
+
+
+async def arun_candidates(candidates, attempt, deadline=None):
+    last_error = None
+    for candidate in candidates:
+        timeout = None if deadline is None else max(deadline - time.time(), 0)
+        try:
+            return candidate, await asyncio.wait_for(attempt(candidate), timeout)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            last_error = e
+            logger.warning(f"provider {candidate} failed: {type(e).__name__}: {e}")
+            if deadline is not None and time.time() >= deadline:
+                break
+    raise last_error
@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import json
+import re
+import threading
+
+from litellm.utils import Delta, ModelResponse, StreamingChoices
+from loguru import logger
+
+from .cache import DiskCache, get_cache_path
+from .config import load_config
+from .embeddings import cosine_similarity, get_embedding
+
+
+def normalize_messages(messages):
+    return [{"role": message["role"], "content": " ".join((message["content"] or "").split())}
+            for message in messages]
+
+
+def hash_key(*parts):
+    return hashlib.sha1(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    max_semantic_entries = 50
+
+    def __init__(self, cache, semantic_cache=None, similarity_threshold=0.95):
+        self.cache = cache
+        self.semantic_cache = semantic_cache
+        self.similarity_threshold = similarity_threshold
+
+    def get(self, provider, model, messages):
+        messages = normalize_messages(messages)
+        key = hash_key(provider, model, messages)
+        content = self.cache.get(key)
+        if content is not None:
+            logger.debug("response cache hit")
+            return content.decode("utf-8")
+        if self.semantic_cache is None or not messages or messages[-1]["role"] != "user":
+            return None
+        entries = self._get_semantic_entries(provider, model, messages)
+        if not entries:
+            return None
+        vector = get_embedding().embed_query(messages[-1]["content"])
+        best = max(entries, key=lambda entry: cosine_similarity(vector, entry["vector"]))
+        if cosine_similarity(vector, best["vector"]) < self.similarity_threshold:
+            return None
+        content = self.cache.get(best["key"])
+        if content is None:
+            return None
+        logger.debug("response cache semantic hit")
+        return content.decode("utf-8")
+
+    def put(self, provider, model, messages, content):
+        if not content:
+            return
+        messages = normalize_messages(messages)
+        key = hash_key(provider, model, messages)
+        self.cache.set(key, content.encode("utf-8"))
+        if self.semantic_cache is None or not messages or messages[-1]["role"] != "user":
+            return
+        entries = [entry for entry in self._get_semantic_entries(provider, model, messages) if entry["key"] != key]
+        vector = get_embedding().embed_query(messages[-1]["content"])
+        entries.append({"key": key, "vector": vector})
+        self.semantic_cache.set(
+            self._semantic_key(provider, model, messages),
+            json.dumps(entries[-self.max_semantic_entries:]).encode("utf-8")
+        )
+
+    def _semantic_key(self, provider, model, messages):
+        return hash_key(provider, model, messages[:-1])
+
+    def _get_semantic_entries(self, provider, model, messages):
+        entries = self.semantic_cache.get(self._semantic_key(provider, model, messages))
+        return json.loads(entries) if entries else []
+
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    global response_cache
+    with response_cache_lock:
+        if response_cache is None:
+            config = load_config()
+            cache_config = config.get("llm_cache", {})
+            path = cache_config.get("path") or get_cache_path("responses.sqlite")
+            cache = DiskCache(path, cache_config.get("max_entries", 10000), cache_config.get("ttl"))
+            semantic_cache = None
+            if cache_config.get("semantic", False):
+                semantic_cache = DiskCache(
+                    str(path) + ".semantic", cache_config.get("max_entries", 10000), cache_config.get("ttl")
+                )
+            response_cache = ResponseCache(cache, semantic_cache, cache_config.get("similarity_threshold", 0.95))
+    return response_cache
+
+
+def is_cache_enabled():
+    return load_config().get("llm_cache", {}).get("enabled", False)
+
+
+CHUNK_PATTERN = re.compile(r"\S+\s*|\s+")
+
+
+def replay_stream(content, chunk_chars=16):
+    pieces = []
+    buffer = ""
+    for match in CHUNK_PATTERN.finditer(content):
+        buffer += match.group(0)
+        if len(buffer) >= chunk_chars:
+            pieces.append(buffer)
+            buffer = ""
+    if buffer:
+        pieces.append(buffer)
+    for i, piece in enumerate(pieces):
+        finish_reason = "stop" if i == len(pieces) - 1 else None
+        new_chunk = ModelResponse(stream=True)
+        new_chunk.choices = [StreamingChoices(finish_reason, i, Delta(piece, role="assistant"))]
+        yield new_chunk
+
+
+def record_stream(response, callback):
+    content = ""
+    for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            content += chunk.choices[0].delta.content
+        yield chunk
+    callback(content)
+
+
+async def areplay_stream(content, chunk_chars=16):
+    for chunk in replay_stream(content, chunk_chars):
+        yield chunk
+
+
+async def arecord_stream(response, callback):
+    content = ""
+    async for chunk in response:
+        if chunk.choices and chunk.choices[0].delta.content:
+            content += chunk.choices[0].delta.content
+        yield chunk
+    await asyncio.to_thread(callback, content)
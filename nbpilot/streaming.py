@@ -0,0 +1,106 @@
+import re
+import time
+
+from IPython.display import display, Markdown
+
+
+class StreamingOutputParser:
+    APPLICABLE_REFERENCE = "applicable references"
+    ANSWER = "answer"
+    FOLLOW_UP_QUESTIONS = "follow-up questions"
+    CITATION_PATTERN = re.compile(r"\[citation:(\d+)\]")
+    QUESTION_MARK = re.compile("[?？]")
+
+    def __init__(self):
+        self.raw_parts = []
+        self.partial = ""
+        self.n_lines = 0
+        self.valid = None
+        self.start = None
+        self.end = None
+        self.answer_lines = []
+        self.question_lines = []
+
+    def feed(self, text):
+        self.raw_parts.append(text)
+        *lines, self.partial = (self.partial + text).split("\n")
+        for line in lines:
+            scanned = self._scan(line)
+            if scanned is None:
+                continue
+            line, self.valid, self.start, self.end, section = scanned
+            self.n_lines += 1
+            if section == "answer":
+                self.answer_lines.append(line)
+            elif section == "questions":
+                self.question_lines.append(line)
+
+    def _scan(self, line):
+        if self.n_lines == 0:
+            line = line.lstrip()
+            if not line:
+                return None
+        idx = self.n_lines
+        valid, start, end = self.valid, self.start, self.end
+        if idx == 0:
+            lowered = line.lower()
+            valid = lowered.startswith(self.APPLICABLE_REFERENCE) and \
+                self.CITATION_PATTERN.search(lowered[1:]) is not None
+        else:
+            lowered = line.strip().lower()
+            if start is None and lowered.startswith(self.ANSWER):
+                start = idx
+            if start is not None and end is None and lowered.startswith(self.FOLLOW_UP_QUESTIONS):
+                end = idx
+        section = None
+        if end is not None and idx >= end:
+            section = "questions"
+        elif start is not None and idx >= start:
+            section = "answer"
+        return line, valid, start, end, section
+
+    def result(self):
+        result = {"raw": "".join(self.raw_parts)}
+        answer_lines, question_lines = self.answer_lines, self.question_lines
+        valid, start, end = self.valid, self.start, self.end
+        scanned = self._scan(self.partial) if self.partial else None
+        if scanned is not None:
+            line, valid, start, end, section = scanned
+            if section == "answer":
+                answer_lines = answer_lines + [line]
+            elif section == "questions":
+                question_lines = question_lines + [line]
+        if not valid or start is None:
+            return result
+        answer = "\n".join(answer_lines).strip()
+        result["answer"] = answer[len(self.ANSWER)+1:].strip()
+        text = "\n".join(question_lines).strip()
+        text = text[len(self.FOLLOW_UP_QUESTIONS)+1:].strip()
+        splits = text.split("\n")
+        if len(splits) != 3:
+            splits = self.QUESTION_MARK.split(text)
+        result["followup-questions"] = [split.strip() for split in splits]
+        return result
+
+
+class MarkdownStream:
+    def __init__(self, min_interval=0.2, max_interval=2.0, chars_per_second=20000):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.chars_per_second = chars_per_second
+        self.interval = min_interval
+        self.last_update = 0
+        self.handle = None
+
+    def due(self):
+        return time.time() - self.last_update >= self.interval
+
+    def update(self, md):
+        start = time.time()
+        if self.handle is None:
+            self.handle = display(Markdown(md), display_id=True)
+        else:
+            self.handle.update(Markdown(md))
+        cost = time.time() - start
+        self.interval = min(max(self.min_interval, cost * 10, len(md) / self.chars_per_second), self.max_interval)
+        self.last_update = time.time()
@@ -1,53 +1,214 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed
+import contextvars
 import json
+import re
+import threading
+import time
+from urllib.parse import urldefrag, urljoin, urlparse
+from xml.etree import ElementTree
 
 import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
 from tavily import TavilyClient
 
+from .cache import DiskCache, get_cache_path
 from .config import load_config
+from .rate_limit import rate_limited
+from .tracing import set_attributes, traced
 
 
 config = load_config()
 tavily = TavilyClient(api_key=config["tools"]["search"]["tavily_search_api_key"])
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=32))
 
 
-def get_search_results(query, engine="ms", max_tokens=None):
-    if engine == "ms":
-        search_url = "https://api.bing.microsoft.com/v7.0/search"
-        headers = {"Ocp-Apim-Subscription-Key": config["tools"]["search"]["azure_search_api_key"]}
-        params = {"q": query, "mkt": "en-US"}
-        response = requests.get(search_url, headers=headers, params=params, timeout=5)
-        response.raise_for_status()
-        search_results = response.json()
-        search_results = search_results["webPages"]["value"]
-        for result in search_results:
-            result["title"] = result["name"]
-            del result["name"]
-            result["content"] = result["snippet"]
-            del result["snippet"]
-    elif engine == "tavily":
-        if max_tokens is None:
-            response = tavily.search(
-                query=query, search_depth="advanced", max_results=10, include_domains=None,
-                exclude_domains=None
-            )
-            search_results = response["results"]
-        else:
-            response = tavily.get_search_context(
-                query=query, search_depth="advanced", max_tokens=max_tokens, max_results=10,
-                include_domains=None, exclude_domains=None
+caches = {}
+caches_lock = threading.Lock()
+
+
+def get_tool_cache(name):
+    cache_config = config["tools"].get("cache", {})
+    if not cache_config.get("enabled", True):
+        return None
+    with caches_lock:
+        if name not in caches:
+            ttl = cache_config.get("search_ttl", 3600) if name == "search" else None
+            caches[name] = DiskCache(
+                get_cache_path(f"{name}.sqlite"),
+                max_entries=cache_config.get("max_entries", 2000),
+                ttl=ttl,
+                max_bytes=cache_config.get("max_bytes")
             )
-            search_results = [json.loads(result) for result in json.loads(response)]
+    return caches[name]
+
+
+def get_search_results(query, engine="ms", max_tokens=None):
+    engines = resolve_search_engines(engine)
+    if len(engines) > 1:
+        return search_engines(query, engines, max_tokens)
+    return search_with_cache(engines[0], query, max_tokens)
+
+
+@traced("tools.search")
+def search_with_cache(engine, query, max_tokens=None):
+    set_attributes(engine=engine)
+    search_cache = get_tool_cache("search")
+    key = json.dumps([engine, query, max_tokens], ensure_ascii=False)
+    if search_cache is not None:
+        search_results = search_cache.get(key)
+        if search_results is not None:
+            logger.debug(f"search results of {engine} read from cache")
+            set_attributes(cache_hit=True)
+            return json.loads(search_results)
+    with rate_limited("search", engine):
+        search_results = SEARCH_ENGINES[engine](query, max_tokens)
+    set_attributes(results=len(search_results or []))
+    if search_cache is not None and search_results:
+        search_cache.set(key, json.dumps(search_results, ensure_ascii=False).encode("utf-8"))
+    return search_results
+
+
+def search_bing(query, max_tokens=None):
+    search_url = config["tools"]["search"].get("bing_url", "https://api.bing.microsoft.com/v7.0/search")
+    headers = {"Ocp-Apim-Subscription-Key": config["tools"]["search"]["azure_search_api_key"]}
+    params = {"q": query, "mkt": "en-US"}
+    response = session.get(search_url, headers=headers, params=params, timeout=5)
+    response.raise_for_status()
+    search_results = response.json()
+    search_results = search_results["webPages"]["value"]
+    for result in search_results:
+        result["title"] = result["name"]
+        del result["name"]
+        result["content"] = result["snippet"]
+        del result["snippet"]
+    return search_results
+
+
+def search_tavily(query, max_tokens=None):
+    if max_tokens is None:
+        response = tavily.search(
+            query=query, search_depth="advanced", max_results=10, include_domains=None,
+            exclude_domains=None
+        )
+        search_results = response["results"]
+    else:
+        response = tavily.get_search_context(
+            query=query, search_depth="advanced", max_tokens=max_tokens, max_results=10,
+            include_domains=None, exclude_domains=None
+        )
+        search_results = [json.loads(result) for result in json.loads(response)]
+    return search_results
+
+
+SEARCH_ENGINES = {"ms": search_bing, "tavily": search_tavily}
+
 
+def resolve_search_engines(engine):
+    if engine == "all":
+        return config["tools"]["search"].get("engines", list(SEARCH_ENGINES))
+    if isinstance(engine, str):
+        return [split.strip() for split in engine.split(",") if split.strip()]
+    return list(engine)
+
+
+def normalize_url(url):
+    parsed = urlparse(url.strip())
+    netloc = parsed.netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    query = "&".join(
+        param for param in sorted(parsed.query.split("&")) if param and not param.startswith("utm_")
+    )
+    path = parsed.path.rstrip("/")
+    return f"{netloc}{path}?{query}" if query else f"{netloc}{path}"
+
+
+@traced("tools.search_engines")
+def search_engines(query, engines, max_tokens=None, min_results=None, latency_budget=None):
+    search_config = config["tools"]["search"]
+    if min_results is None:
+        min_results = search_config.get("min_results", 8)
+    if latency_budget is None:
+        latency_budget = search_config.get("latency_budget", 3)
+    executor = ThreadPoolExecutor(max_workers=len(engines))
+    futures = {
+        executor.submit(contextvars.copy_context().run, search_with_cache, engine, query, max_tokens): engine
+        for engine in engines
+    }
+    search_results = []
+    seen_urls = set()
+    try:
+        for future in as_completed(futures, timeout=latency_budget):
+            engine = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                logger.warning(f"search engine {engine} failed: {e}")
+                continue
+            for result in results:
+                url = normalize_url(result["url"])
+                if url in seen_urls:
+                    continue
+                seen_urls.add(url)
+                result["engine"] = engine
+                search_results.append(result)
+            if len(search_results) >= min_results:
+                break
+    except FuturesTimeoutError:
+        logger.warning(f"search latency budget of {latency_budget}s exceeded")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    set_attributes(engines=",".join(engines), results=len(search_results))
     return search_results
 
 
-def fetch_webpage_content(url, timeout=20):
-    url = "https://r.jina.ai/" + url
+@traced("tools.fetch")
+def fetch_webpage_content(url, timeout=20, revalidate=False):
+    set_attributes(url=url)
+    page_cache = get_tool_cache("pages")
+    entry = page_cache.get(url) if page_cache is not None else None
+    entry = json.loads(entry) if entry is not None else None
+    headers = {}
+    if entry is not None:
+        page_ttl = config["tools"].get("cache", {}).get("page_ttl", 86400)
+        if not revalidate and time.time() - entry["fetched_at"] < page_ttl:
+            logger.debug(f"content of {url} read from cache")
+            set_attributes(cache_hit=True)
+            return entry["content"]
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
     try:
-        response = requests.get(url, timeout=timeout)
-        return parse_content(response.text)
+        reader_url = config["tools"].get("reader_url", "https://r.jina.ai/")
+        response = session.get(reader_url + url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and entry is not None:
+            logger.debug(f"content of {url} not modified")
+            set_attributes(not_modified=True)
+            content = entry["content"]
+        else:
+            content = parse_content(response.text)
+            set_attributes(status_code=response.status_code, chars=len(content["content"] or ""))
+            if not response.ok and entry is not None:
+                logger.debug(f"fail to revalidate {url} ({response.status_code}), using cached content")
+                return entry["content"]
+            if not response.ok or not content["content"]:
+                return content
+            entry = {
+                "content": content,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified")
+            }
+        if page_cache is not None:
+            entry["fetched_at"] = time.time()
+            page_cache.set(url, json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+        return content
     except:
-        return None
+        return entry["content"] if entry is not None else None
 
 
 def parse_content(content):
@@ -66,3 +227,68 @@ def parse_content(content):
         if line.startswith(CONTENT_START):
             content = "\n".join(lines[i+1:]).strip()
     return {"title": title, "source": source, "content": content}
+
+
+def fetch_webpages(urls, max_workers=8, timeout=20, revalidate=False):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_webpage_content, url, timeout, revalidate): url for url in urls}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def get_sitemap_urls(sitemap_url, timeout=20):
+    response = session.get(sitemap_url, timeout=timeout)
+    response.raise_for_status()
+    root = ElementTree.fromstring(response.content)
+    urls = []
+    for element in root.iter():
+        if not element.tag.endswith("loc") or not element.text:
+            continue
+        url = element.text.strip()
+        if root.tag.endswith("sitemapindex"):
+            urls.extend(get_sitemap_urls(url, timeout))
+        else:
+            urls.append(url)
+    return urls
+
+
+LINK_PATTERN = re.compile(r"\]\((https?://[^)\s]+)")
+
+
+def extract_links(base_url, content):
+    links = []
+    for match in LINK_PATTERN.finditer(content or ""):
+        link, _ = urldefrag(urljoin(base_url, match.group(1)))
+        links.append(link)
+    return links
+
+
+def crawl_webpages(urls, depth=0, max_workers=8, max_pages=200, timeout=20, revalidate=False):
+    prefixes = []
+    for url in urls:
+        parsed = urlparse(url)
+        prefixes.append((parsed.netloc, parsed.path.rsplit("/", 1)[0]))
+
+    def in_scope(url):
+        parsed = urlparse(url)
+        return any(parsed.netloc == netloc and parsed.path.startswith(path) for netloc, path in prefixes)
+
+    visited = set()
+    level = []
+    for url in urls:
+        if url not in visited:
+            visited.add(url)
+            level.append(url)
+    for current_depth in range(depth + 1):
+        next_level = []
+        for url, content in fetch_webpages(level, max_workers, timeout, revalidate):
+            yield url, content
+            if content is None or current_depth == depth:
+                continue
+            for link in extract_links(url, content["content"]):
+                if link not in visited and len(visited) < max_pages and in_scope(link):
+                    visited.add(link)
+                    next_level.append(link)
+        if not next_level:
+            break
+        level = next_level
@@ -0,0 +1,243 @@
+from collections import deque
+from contextlib import contextmanager
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+
+from loguru import logger
+
+from .config import load_config
+
+
+current_span = contextvars.ContextVar("nbpilot_span", default=None)
+
+
+class Span:
+    def __init__(self, name, parent=None, **attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = {}
+        self.set(**attributes)
+        self.start_time = time.time()
+        self.end_time = None
+        self.status = "ok"
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update((key, value) for key, value in attributes.items() if value is not None)
+
+    @property
+    def duration(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def end(self, error=None):
+        if self.end_time is not None:
+            return
+        self.end_time = time.time()
+        if error is not None:
+            self.status = "error"
+            self.error = f"{type(error).__name__}: {error}"
+        tracer.record(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "start_time_unix_nano": int(self.start_time * 1e9),
+            "end_time_unix_nano": int(self.end_time * 1e9) if self.end_time else None,
+            "attributes": self.attributes,
+            "status": {"code": self.status, "message": self.error}
+        }
+
+
+class Tracer:
+    def __init__(self, enabled=True, max_spans=10000, export_path=None):
+        self.enabled = enabled
+        self.spans = deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+        self.export_file = None
+        if export_path:
+            self.export_to(export_path)
+
+    def export_to(self, path):
+        with self.lock:
+            if self.export_file is not None:
+                self.export_file.close()
+                self.export_file = None
+            if path:
+                path = os.path.expanduser(path)
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                self.export_file = open(path, "a", encoding="utf-8")
+
+    def record(self, span):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.spans.append(span)
+            if self.export_file is not None:
+                try:
+                    self.export_file.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+                    self.export_file.flush()
+                except (OSError, ValueError) as e:
+                    logger.warning(f"fail to export span: {e}")
+
+    def dump(self, path):
+        with self.lock:
+            spans = list(self.spans)
+        with open(os.path.expanduser(path), "w", encoding="utf-8") as fo:
+            for span in spans:
+                fo.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+        return len(spans)
+
+    def clear(self):
+        with self.lock:
+            self.spans.clear()
+
+    def stats(self):
+        with self.lock:
+            spans = list(self.spans)
+        groups = {}
+        for span in spans:
+            key = (span.name, span.attributes.get("provider"), span.attributes.get("model"))
+            groups.setdefault(key, []).append(span)
+        rows = []
+        for (name, provider, model), group in groups.items():
+            durations = sorted(span.duration for span in group)
+            ttfts = [span.attributes["ttft"] for span in group if "ttft" in span.attributes]
+            speeds = [span.attributes["tokens_per_second"] for span in group if "tokens_per_second" in span.attributes]
+            rows.append({
+                "name": name,
+                "provider": provider,
+                "model": model,
+                "count": len(group),
+                "errors": sum(span.status == "error" for span in group),
+                "total": sum(durations),
+                "p50": percentile(durations, 50),
+                "p95": percentile(durations, 95),
+                "ttft": sum(ttfts) / len(ttfts) if ttfts else None,
+                "tokens_per_second": sum(speeds) / len(speeds) if speeds else None,
+                "prompt_tokens": sum(span.attributes.get("prompt_tokens", 0) for span in group),
+                "completion_tokens": sum(span.attributes.get("completion_tokens", 0) for span in group)
+            })
+        return sorted(rows, key=lambda row: row["total"], reverse=True)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def create_tracer():
+    tracing_config = load_config().get("tracing", {})
+    return Tracer(
+        tracing_config.get("enabled", True),
+        tracing_config.get("max_spans", 10000),
+        tracing_config.get("export_path")
+    )
+
+
+tracer = create_tracer()
+
+
+def start_span(name, **attributes):
+    return Span(name, current_span.get(), **attributes)
+
+
+@contextmanager
+def span(name, **attributes):
+    new_span = start_span(name, **attributes)
+    token = current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.end(e)
+        raise
+    finally:
+        current_span.reset(token)
+        new_span.end()
+
+
+def traced(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_attributes(**attributes):
+    active_span = current_span.get()
+    if active_span is not None:
+        active_span.set(**attributes)
+
+
+class StreamTrace:
+    def __init__(self, stream_span, count_tokens=None):
+        self.span = stream_span
+        self.count_tokens = count_tokens
+        self.first_token_time = None
+        self.parts = []
+        self.usage = None
+
+    def observe(self, chunk):
+        if chunk.choices and chunk.choices[0].delta.content:
+            if self.first_token_time is None:
+                self.first_token_time = time.time()
+                self.span.set(ttft=self.first_token_time - self.span.start_time)
+            self.parts.append(chunk.choices[0].delta.content)
+        self.usage = getattr(chunk, "usage", None) or self.usage
+
+    def finish(self, error=None):
+        if isinstance(error, GeneratorExit):
+            self.span.set(closed_early=True)
+            error = None
+        set_usage(self.span, self.usage, "".join(self.parts), self.count_tokens)
+        if self.first_token_time is not None:
+            generation_time = time.time() - self.first_token_time
+            tokens = self.span.attributes.get("completion_tokens", 0)
+            if generation_time > 0 and tokens > 1:
+                self.span.set(tokens_per_second=(tokens - 1) / generation_time)
+        self.span.end(error)
+
+
+def trace_stream(response, stream_span, count_tokens=None):
+    trace = StreamTrace(stream_span, count_tokens)
+    try:
+        for chunk in response:
+            trace.observe(chunk)
+            yield chunk
+    except BaseException as e:
+        trace.finish(e)
+        raise
+    trace.finish()
+
+
+async def atrace_stream(response, stream_span, count_tokens=None):
+    trace = StreamTrace(stream_span, count_tokens)
+    try:
+        async for chunk in response:
+            trace.observe(chunk)
+            yield chunk
+    except BaseException as e:
+        trace.finish(e)
+        raise
+    trace.finish()
+
+
+def set_usage(llm_span, usage, content, count_tokens=None):
+    prompt_tokens = getattr(usage, "prompt_tokens", None) if usage is not None else None
+    completion_tokens = getattr(usage, "completion_tokens", None) if usage is not None else None
+    if completion_tokens is None and count_tokens is not None:
+        completion_tokens = count_tokens(content or "")
+    llm_span.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
@@ -16,7 +16,8 @@ setuptools.setup(
     zip_safe=False,
     entry_points = {  
         'console_scripts': [  
-             'nbpilot = nbpilot.__main__:main'  
+             'nbpilot = nbpilot.__main__:main',
+             'nbpilot-embedding-server = nbpilot.embedding_server:main'
          ]  
     }
 )